@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+import argparse
+import contextlib
+import copy
+import gc
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import warnings
+
+warnings.filterwarnings("ignore")
+
+
+CATEGORIES = ['eqtq', 'drive', 'plc']
+PLOTTING = ['plotly.io', 'plotly.express', 'plotly.graph_objects', 'matplotlib.pyplot']
+
+
+def _extract_obj(category, machinery, data_path, reader):
+    from modules.config import EQTQ, DRIVE, PLC
+    from modules.preprocessing import Extract, ExtractPlc
+
+    data = {'eqtq': EQTQ, 'drive': DRIVE, 'plc': PLC}[category]()
+    extractor = ExtractPlc if category == 'plc' else Extract
+    return extractor(data.all_sensors, category, machinery, data_path=data_path, reader=reader, verbose=False)
+
+
+def run_fill(args):
+    """
+    Runs the extraction chain of one category in this process and prints the
+    peak RSS and the peak python allocations of the fill_data() step.
+    """
+    extract_obj = _extract_obj(args.category, args.machinery, args.data_path, args.reader)
+    extracted_data = extract_obj.extract_raw_data()
+    gc.collect()
+
+    # The preprocessed frames are traced too, the in-place mode frees them while the sensors are filled
+    tracemalloc.start()
+    _, det_sensors = extract_obj.preprocess_data(extracted_data)
+    start = time.perf_counter()
+    if args.mode == 'deepcopy':
+        # The copy fill_data() used to make before filling every sensor
+        extracted_data = copy.deepcopy(extracted_data)
+    filled_df = extract_obj.fill_data(extracted_data, det_sensors, inplace=args.mode == 'inplace')
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'{args.category:<6} {args.mode:<9} fill {elapsed * 1000:8.1f} ms   '
+          f'traced peak {peak / 2**20:7.2f} MB   max rss {rss:7.1f} MB   sensors {len(filled_df)}')
+
+
+def memory(args):
+    """
+    Compares the memory of fill_data() with the old deep copy, the default
+    copy of the dictionary and the in-place mode. Every run uses a new
+    process, so the peak RSS of a run does not depend on the previous ones.
+    """
+    for category in args.categories:
+        for mode in ['deepcopy', 'copy', 'inplace']:
+            subprocess.run([
+                sys.executable, __file__,
+                '--machinery', args.machinery,
+                '--data-path', args.data_path,
+                '--reader', args.reader,
+                'fill', '--category', category, '--mode', mode,
+            ], check=True)
+
+
+def imports(args):
+    """
+    Measures the cold import time of the modules loaded by server.py and by
+    the training subprocesses. Every import runs in a new interpreter. The
+    eager rows import the plotting stacks first, as modules.preprocessing
+    used to do at import time.
+    """
+    for target in args.targets:
+        for mode in ['eager', 'lazy']:
+            preload = ''.join(f'import {name}; ' for name in PLOTTING) if mode == 'eager' else ''
+            code = (
+                'import sys, time; start = time.perf_counter(); '
+                f'{preload}import {target}; '
+                'print(time.perf_counter() - start, any(name.startswith("plotly") for name in sys.modules))'
+            )
+            times = []
+            for _ in range(args.repeat):
+                output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True)
+                elapsed, plotly_loaded = output.stdout.split()[-2:]
+                times.append(float(elapsed))
+            print(f'{target:<22} {mode:<6} median {statistics.median(times) * 1000:8.1f} ms   '
+                  f'min {min(times) * 1000:8.1f} ms   plotly loaded {plotly_loaded}')
+
+
+def _checkpoints(args):
+    """
+    Returns the checkpoint of each head, as Generate() looks them up.
+    """
+    root = f'{args.checkpoints_dir}/{args.machinery}/{args.category}'
+    heads = [f'Head_{i:>02}' for i in range(1, args.heads + 1)]
+    if args.multi_head:
+        return {head: f'{root}/heads/{args.sensor}.ckpt' for head in heads}
+    return {head: f'{root}/{head}/{args.sensor}.ckpt' for head in heads}
+
+
+def _head_windows(args, backend='checkpoint'):
+    """
+    Loads the model of each head, or the multi-head model of the sensor, and
+    the last encoder window of each head, as Generate() does, but on the
+    device given on the command line.
+    """
+    from modules.config import EQTQ, DRIVE, InferArgs, TrainArgs
+    from modules.preprocessing import Extract
+    from modules.registry import registry, models as model_cache
+
+    train_args = TrainArgs(target='Head_01')
+    data_obj = {'eqtq': EQTQ, 'drive': DRIVE}[args.category](heads=InferArgs.heads, machinery=args.machinery)
+    data_obj.set_sensors(data_obj.all_sensors)
+    data_obj.set_unk_variables()
+    filled_df, _ = registry.get(Extract, data_obj.sensors, args.category, args.machinery,
+                                data_path=args.data_path, reader=args.reader, verbose=False,
+                                tail=train_args.max_encoder_length)
+    data_obj.load_data(filled_df)
+    data = data_obj.get_sensor(args.sensor, tail=train_args.max_encoder_length)
+
+    models, windows = {}, {}
+    for head, path in _checkpoints(args).items():
+        models[head] = model_cache.get(path, args.device, backend)
+        windows[head] = data[['time_idx', head, 'day']].assign(**{head: data[head].abs()})
+        if args.multi_head:
+            windows[head] = windows[head].rename(columns={head: 'value'}).assign(head=head)
+    return models, windows
+
+
+def predict(args):
+    """
+    Compares the per-tick latency of one Trainer.predict() call per head with
+    the batched Trainer.predict_batch() path and the direct Trainer.forecast()
+    path used by Generate.predict(), and checks that all of them return the
+    same forecasts.
+    """
+    import logging
+
+    logging.disable(logging.WARNING)
+    models, windows = _head_windows(args)
+
+    def loop():
+        with open(os.devnull, 'w') as handle, contextlib.redirect_stdout(handle):
+            return {head: models[head].predict(windows[head], plot=False).output.prediction for head in models}
+
+    def grouped(method):
+        def run():
+            groups = {}
+            for head in models:
+                groups.setdefault(id(models[head].model), []).append(head)
+            output = {}
+            for heads in groups.values():
+                predictions = getattr(models[heads[0]], method)([windows[head] for head in heads])
+                output.update(zip(heads, predictions))
+            return output
+        return run
+
+    reference = loop()
+    for name, run in [('loop', loop), ('batch', grouped('predict_batch')), ('direct', grouped('forecast'))]:
+        output = run()
+        error = max(float((output[head] - reference[head]).abs().max()) for head in models)
+        times = []
+        for _ in range(args.ticks):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        print(f'{args.sensor:<12} {name:<6} heads {len(models):>2}   median {statistics.median(times) * 1000:8.1f} ms/tick   '
+              f'min {min(times) * 1000:8.1f} ms   max abs diff {error:.2e}')
+
+
+def _rss() -> float:
+    # Current resident memory of the process, in MB
+    with open('/proc/self/statm') as handle:
+        return int(handle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+def _forecast(models, windows):
+    from modules.generators import forecast_windows
+
+    heads = list(models)
+    return dict(zip(heads, forecast_windows([(models[head], windows[head]) for head in heads])))
+
+
+def run_backend(args):
+    """
+    Loads the models of a sensor with one backend of ModelRegistry.get() in
+    this process and prints the load time, the resident memory added by the
+    models (after loading and after the ticks) and the per-tick latency of forecast_windows(), as used by the
+    generators. The forecasts are compared with the checkpoint backend.
+    """
+    import logging
+    import torch
+
+    logging.disable(logging.WARNING)
+    gc.collect()
+    rss = _rss()
+    start = time.perf_counter()
+    models, windows = _head_windows(args, args.backend)
+    load = time.perf_counter() - start
+    gc.collect()
+    added = _rss() - rss
+
+    output = _forecast(models, windows)
+    times = []
+    for _ in range(args.ticks):
+        start = time.perf_counter()
+        _forecast(models, windows)
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    warm = _rss() - rss
+
+    reference = _forecast(*_head_windows(args))
+    error = max(float((output[head] - reference[head]).abs().max()) for head in models)
+    print(f'{args.sensor:<12} {args.backend:<11} heads {len(models):>2}   load {load * 1000:8.1f} ms   '
+          f'rss +{added:6.1f} MB (+{warm:6.1f} MB warm)   median {statistics.median(times) * 1000:7.1f} ms/tick   '
+          f'min {min(times) * 1000:7.1f} ms   max abs diff {error:.2e}   threads {torch.get_num_threads()}')
+
+
+def quantize(args):
+    """
+    Compares the float models of a sensor with their int8 version
+    (quantize_model(), as loaded by Trainer.load_model(quantize=True)): the
+    memory of the weights, the per-tick latency of forecast_windows() and the
+    difference of the forecasts. The relative error of the accuracy check of
+    Trainer.check_quantization() is printed when it has been run.
+    """
+    import json
+    import logging
+    import torch
+    from modules.registry import ModelRegistry
+    from modules.trainer import quantization_path, quantize_model
+
+    logging.disable(logging.WARNING)
+    models, windows = _head_windows(args)
+    quantized, copies = {}, {}
+    for head, trainer in models.items():
+        # The heads of a multi-head model keep sharing one int8 model
+        if id(trainer.model) not in copies:
+            copies[id(trainer.model)] = copy.copy(trainer)
+            copies[id(trainer.model)].model = quantize_model(trainer.model)
+        quantized[head] = copies[id(trainer.model)]
+    checks = [path for path in set(_checkpoints(args).values()) if os.path.exists(quantization_path(path))]
+    errors = [json.load(open(quantization_path(path)))['error'] for path in checks]
+
+    reference = _forecast(models, windows)
+    for name, variant in [('float', models), ('int8', quantized)]:
+        output = _forecast(variant, windows)
+        error = max(float((output[head] - reference[head]).abs().max()) for head in models)
+        nbytes = sum(ModelRegistry._size(trainer.model) for trainer in {id(t.model): t for t in variant.values()}.values())
+        times = []
+        for _ in range(args.ticks):
+            start = time.perf_counter()
+            _forecast(variant, windows)
+            times.append(time.perf_counter() - start)
+        print(f'{args.sensor:<12} {name:<6} heads {len(models):>2}   weights {nbytes / 2**10:8.1f} KB   '
+              f'median {statistics.median(times) * 1000:7.1f} ms/tick   min {min(times) * 1000:7.1f} ms   '
+              f'max abs diff {error:.2e}   threads {torch.get_num_threads()}')
+    if errors:
+        print(f'accuracy check of {len(errors)} checkpoints: max relative error {max(errors):.4f}')
+
+
+def export(args):
+    """
+    Exports the checkpoints of a sensor that have no up-to-date TorchScript
+    artifact (Trainer.export()), then compares the checkpoint and the
+    torchscript backends of the generators. Every backend runs in a new
+    process, so the resident memory of a run does not depend on the other.
+    """
+    from modules.trainer import Trainer, exported_path
+
+    for path in sorted(set(_checkpoints(args).values())):
+        artifact = exported_path(path)
+        if not os.path.exists(artifact) or os.path.getmtime(artifact) < os.path.getmtime(path):
+            print(f'exporting {path}')
+            Trainer().export(path)
+
+    for backend in ['checkpoint', 'torchscript']:
+        subprocess.run([
+            sys.executable, __file__,
+            '--machinery', args.machinery,
+            '--data-path', args.data_path,
+            '--reader', args.reader,
+            'backend', '--backend', backend,
+            '--category', args.category, '--sensor', args.sensor, '--heads', str(args.heads),
+            '--checkpoints-dir', args.checkpoints_dir, '--ticks', str(args.ticks),
+            *(['--multi-head'] if args.multi_head else []),
+        ], check=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the data generation module.')
+    parser.add_argument('--machinery', default='JF890')
+    parser.add_argument('--data-path', default='./data')
+    parser.add_argument('--reader', default='json', choices=['json', 'bson'])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cmd = commands.add_parser('memory', help='peak memory of fill_data() for each category')
+    cmd.add_argument('--categories', nargs='+', default=CATEGORIES, choices=CATEGORIES)
+    cmd.set_defaults(func=memory)
+
+    cmd = commands.add_parser('imports', help='cold import time with and without the plotting stacks')
+    cmd.add_argument('--targets', nargs='+', default=['modules.preprocessing', 'train', 'server'])
+    cmd.add_argument('--repeat', type=int, default=5)
+    cmd.set_defaults(func=imports)
+
+    cmd = commands.add_parser('fill', help='single fill_data() run, used by memory')
+    cmd.add_argument('--category', required=True, choices=CATEGORIES)
+    cmd.add_argument('--mode', default='copy', choices=['deepcopy', 'copy', 'inplace'])
+    cmd.set_defaults(func=run_fill)
+
+    cmd = commands.add_parser('predict', help='per-tick latency of the head models of a sensor')
+    cmd.add_argument('--category', default='eqtq', choices=['eqtq', 'drive'])
+    cmd.add_argument('--sensor', default='LockDegree')
+    cmd.add_argument('--heads', type=int, default=24)
+    cmd.add_argument('--device', default='cpu')
+    cmd.add_argument('--checkpoints-dir', default='./checkpoints')
+    cmd.add_argument('--ticks', type=int, default=10)
+    cmd.add_argument('--multi-head', action='store_true', help='one model for all the heads (TrainArgs.multi_head)')
+    cmd.set_defaults(func=predict)
+
+    cmd = commands.add_parser('quantize', help='memory and latency of the int8 head models of a sensor (halves the weights, slower than float with hidden_size 8)')
+    cmd.add_argument('--category', default='eqtq', choices=['eqtq', 'drive'])
+    cmd.add_argument('--sensor', default='LockDegree')
+    cmd.add_argument('--heads', type=int, default=24)
+    cmd.add_argument('--checkpoints-dir', default='./checkpoints')
+    cmd.add_argument('--ticks', type=int, default=20)
+    cmd.add_argument('--multi-head', action='store_true', help='one model for all the heads (TrainArgs.multi_head)')
+    cmd.set_defaults(func=quantize, device='cpu')
+
+    for name, func, help in [('export', export, 'latency and memory of the exported TorchScript models'),
+                             ('backend', run_backend, 'single backend run, used by export')]:
+        cmd = commands.add_parser(name, help=help)
+        cmd.add_argument('--category', default='eqtq', choices=['eqtq', 'drive'])
+        cmd.add_argument('--sensor', default='LockDegree')
+        cmd.add_argument('--heads', type=int, default=24)
+        cmd.add_argument('--checkpoints-dir', default='./checkpoints')
+        cmd.add_argument('--ticks', type=int, default=20)
+        cmd.add_argument('--multi-head', action='store_true', help='one model for all the heads (TrainArgs.multi_head)')
+        if name == 'backend':
+            cmd.add_argument('--backend', default='checkpoint', choices=['checkpoint', 'torchscript'])
+        cmd.set_defaults(func=func, device='cpu')
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, os.getcwd())
+    main()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+_digests = {}
+
+
+def file_digest(path, chunk_size=1 << 20) -> str:
+    """
+    Computes the sha1 digest of a file. The result is memoized on the file
+    size and modification time, so repeated calls in the same process do not
+    read the file again.
+
+    Args:
+        path (str): path of the file.
+        chunk_size (int): number of bytes read at each step.
+
+    Returns:
+        str: hexadecimal digest of the file content.
+    """
+    stat = os.stat(path)
+    memo = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo not in _digests:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(chunk_size), b''):
+                sha.update(chunk)
+        _digests[memo] = sha.hexdigest()
+    return _digests[memo]
+
+
+class FrameCache:
+    """
+    This class have been designed to persist the extracted sensor frames of
+    the Extract() and ExtractPlc() classes. Every sensor frame is stored as a
+    pair of .npy files (index and values) plus a small json file with the
+    column names and dtypes, so later runs can memory-map the frames instead
+    of parsing the MongoDB json files again.
+
+
+    Methods:
+        key(source_path, **options):
+            Builds the cache key of a source file and its extraction options.
+        load(key, sensors):
+            Loads the cached frames of the sensors, None if any is missing.
+        save(key, sensor_dict):
+            Stores the frames of a dictionary of sensors.
+    """
+    def __init__(
+            self,
+            cache_dir: str = './cache',
+            mmap: bool = True
+            ):
+        """
+        Initialize a new instance of FrameCache.
+
+        Args:
+            cache_dir (str): directory where the frames are stored.
+            mmap (bool): whether to memory-map the cached values (read-only).
+        """
+        self.cache_dir = cache_dir
+        self.mmap = mmap
+
+    def key(self, source_path, **options) -> str:
+        """
+        Args:
+            source_path (str): path of the raw data file.
+            options: extraction options that change the produced frames.
+
+        Returns:
+            str: name of the cache entry.
+        """
+        name = os.path.splitext(os.path.basename(source_path))[0]
+        digest = hashlib.sha1(file_digest(source_path).encode())
+        digest.update(json.dumps(options, sort_keys=True, default=str).encode())
+        return f'{name}-{digest.hexdigest()[:16]}'
+
+    def _paths(self, key, sensor):
+        base = os.path.join(self.cache_dir, key, sensor)
+        return base + '.json', base + '.index.npy', base + '.values.npy'
+
+    def load(self, key, sensors):
+        """
+        Args:
+            key (str): name of the cache entry.
+            sensors (list): sensors to load.
+
+        Returns:
+            dict: dictionary of the cached frames, None if any sensor is missing.
+        """
+        sensor_dict = {}
+        for sensor in sensors:
+            meta_path, index_path, values_path = self._paths(key, sensor)
+            if not os.path.exists(meta_path):
+                return None
+            with open(meta_path, 'r') as handle:
+                meta = json.load(handle)
+            mmap_mode = 'r' if self.mmap else None
+            index = np.load(index_path, mmap_mode=mmap_mode)
+            values = np.load(values_path, mmap_mode=mmap_mode)
+            df = pd.DataFrame(
+                values,
+                index=pd.DatetimeIndex(index.view('datetime64[ns]'), name=meta['index_name']),
+                columns=meta['columns'],
+                copy=False
+            )
+            dtypes = dict(zip(meta['columns'], meta['dtypes']))
+            if any(str(df[col].dtype) != dtype for col, dtype in dtypes.items()):
+                df = df.astype(dtypes)
+            sensor_dict[sensor] = df
+        return sensor_dict
+
+    def save(self, key, sensor_dict) -> None:
+        """
+        Stores the frames. Every file is written to a temporary path and then
+        renamed, so concurrent processes never read a partial entry.
+
+        Args:
+            key (str): name of the cache entry.
+            sensor_dict (dict): dictionary of sensors and their frames.
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        os.makedirs(entry_dir, exist_ok=True)
+        for sensor, df in sensor_dict.items():
+            meta_path, index_path, values_path = self._paths(key, sensor)
+            meta = {
+                'index_name': df.index.name,
+                'columns': [str(col) for col in df.columns],
+                'dtypes': [str(dtype) for dtype in df.dtypes],
+            }
+            index = pd.DatetimeIndex(df.index).asi8
+            # the json file is renamed last and marks the entry as complete
+            self._atomic_write(values_path, lambda handle: np.save(handle, df.to_numpy()))
+            self._atomic_write(index_path, lambda handle: np.save(handle, index))
+            self._atomic_write(meta_path, lambda handle: handle.write(json.dumps(meta).encode()))
+
+    def _atomic_write(self, path, write):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as handle:
+                write(handle)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
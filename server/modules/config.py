@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
+import pandas as pd
 from dataclasses import dataclass, field
 from typing import Union
 
@@ -10,6 +12,29 @@ def sensor_check(all_sensors: list, sensor: Union[str, list]) -> bool:
     return sum(sit)==len(sensor)
 
 
+def day_category(index) -> pd.Categorical:
+    """Returns the day of each timestamp as a category, built from the integer days instead of a string per row."""
+    days, codes = np.unique(index.day.to_numpy(), return_inverse=True)
+    labels = days.astype(str)
+    # Same categories (and order) as .astype(str).astype("category")
+    order = np.argsort(labels, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return pd.Categorical.from_codes(rank[codes], categories=labels[order].tolist())
+
+
+def stack_heads(data, heads) -> pd.DataFrame:
+    """
+    Returns the head columns of a sensor frame stacked in a single 'value'
+    column, with the head of each row in a 'head' category. It is the
+    training frame of the multi-head models, one model for all the heads.
+    """
+    frames = [data[['time_idx', head, 'day']].rename(columns={head: 'value'}) for head in heads]
+    stacked = pd.concat(frames, ignore_index=True)
+    stacked['head'] = pd.Categorical(np.repeat(heads, [len(frame) for frame in frames]), categories=heads)
+    return stacked
+
+
 @dataclass
 class TrainArgs:
     max_prediction_length: int = 5
@@ -34,6 +59,9 @@ class TrainArgs:
     group_ids: list = field(default_factory=lambda: ["day"])
     path: str = None
     lr_tuning: str = True
+    multi_head: bool = False
+    export: bool = False
+    quantize_check: bool = False
     logs_dir: str = "./logs"
     checkpoints_dir: str = "./checkpoints"
     
@@ -48,6 +76,14 @@ class InferArgs:
     sensor: str = 'LockDegree'
     category: str = 'eqtq'
     machinery: str = 'ejda1'
+    reader: str = 'json'
+    cache_dir: str = './cache'
+    compact: bool = False
+    lookahead: int = None
+    backend: str = 'checkpoint'
+    # int8 weights: half the memory, but slower than float on these models, not a speed option
+    quantize: bool = False
+    quantize_tolerance: float = 0.02
 
 
 
@@ -83,11 +119,17 @@ class BaseSensorData:
     def load_data(self, dataframe):
         self.dataframe = dataframe
     
-    def get_sensor(self, sensor):
-        self.data = self.dataframe[sensor][self.unk_variables]
-        self.data = self.data[~self.data.index.duplicated(keep='first')]
-        self.data['day'] = self.data.index.day.astype(str).astype("category")
-        self.data["time_idx"] = self.data.reset_index().drop(columns=['index']).index
+    def get_sensor(self, sensor, tail=None):
+        # Frames filled with a tail window keep the time indexes of the whole history
+        df = self.dataframe[sensor]
+        rows = np.flatnonzero(~df.index.duplicated(keep='first'))
+        offset = df.attrs.get('time_idx_offset', 0)
+        if tail is not None:
+            offset += max(len(rows) - tail, 0)
+            rows = rows[-tail:]
+        self.data = df.iloc[rows][self.unk_variables]
+        self.data['day'] = day_category(self.data.index)
+        self.data["time_idx"] = offset + np.arange(len(self.data))
         return self.data
 
     def set_unk_variables(self):
@@ -114,13 +156,6 @@ class PLC(BaseSensorData):
     
     def set_unk_variables(self):
         self.unk_variables = ['value']
-    
-    def get_sensor(self, sensor):
-        self.data = self.dataframe[sensor][self.unk_variables]
-        self.data = self.data[~self.data.index.duplicated(keep='first')]
-        self.data['day'] = self.data.index.day.astype(str).astype("category")
-        self.data["time_idx"] = self.data.reset_index().index
-        return self.data
         
     
 @dataclass
@@ -1,19 +1,314 @@
 # -*- coding: utf-8 -*-
 
 import os
-import sys
 import copy
+import contextlib
 import pickle
+import numpy as np
 import pandas as pd
 import logging
-import contextlib
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from modules.preprocessing import ExtractPlc
 from modules.preprocessing import Extract
-from modules.trainer import Trainer
+from modules.registry import registry, models
 from modules.config import EQTQ, DRIVE, PLC, TrainArgs, InferArgs
 
+
+
+class Sample(dict):
+    """
+    Generated sample of GenerateDet(), a dictionary with the time_idx, value
+    and day of the sample and its timestamp as name. It is read like the
+    pandas rows of the other generators (sample[key], sample.value, sample.name).
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, time_idx, key, value, day, now):
+        super().__init__(time_idx=time_idx, **{key: value}, day=day)
+        self.name = now
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+
+def _sample(time_idx, name, value, day, now):
+    """Returns a generated sample in the format of a row of the encoder data."""
+    return pd.Series([time_idx, value, day], index=['time_idx', name, 'day'], dtype=object, name=now)
+
+
+def fault_values(values, std, std_param=3, bias_percent=0.1):
+    """
+    Computes the fault samples of all the heads of a sensor as one array
+    operation. A head with a constant window gets a bias, the others a noise
+    proportional to their standard deviation.
+    
+    Args:
+        values (np.ndarray): last value of each head.
+        std (np.ndarray): standard deviation of the window of each head.
+        std_param (int): Coefficient for generating fault.
+        bias_percent (float): bias for calculating the fault sample.
+    
+    Returns:
+        np.ndarray: fault value of each head.
+    """
+    noisy = std != 0
+    # One draw per noisy head, in the order of the heads, as the loop over the heads did
+    uniform = np.zeros(len(values))
+    uniform[noisy] = [random.uniform(0, 1) for _ in range(np.count_nonzero(noisy))]
+    return np.where(noisy, values + std*(std_param+uniform), values + bias_percent*values)
+
+
+@contextlib.contextmanager
+def quiet_lightning():
+    """
+    Silences the Lightning messages of the model calls, the simulation threads
+    keep logging. The level of the logger is restored even when the call fails.
+    """
+    lightning = logging.getLogger('lightning.pytorch')
+    level = lightning.level
+    lightning.setLevel(logging.ERROR)
+    try:
+        yield
+    finally:
+        lightning.setLevel(level)
+
+
+def forecast_windows(windows):
+    """
+    Runs one Trainer.forecast() call for every group of windows that share
+    the same model weights.
+
+    Args:
+        windows (list): (Trainer, window frame) pairs.
+
+    Returns:
+        list: raw prediction of each window, in the order of the windows.
+    """
+    groups = {}
+    for i, (model, _) in enumerate(windows):
+        groups.setdefault(id(model.model), []).append(i)
+    predictions = [None] * len(windows)
+    for positions in groups.values():
+        models.touch(windows[positions[0]][0])
+        output = windows[positions[0]][0].forecast([windows[i][1] for i in positions])
+        for i, prediction in zip(positions, output):
+            predictions[i] = prediction
+    return predictions
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def inference_executor() -> ThreadPoolExecutor:
+    """Returns the single-thread executor of the look-ahead predictions, shared by all the generators."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inference')
+    return _executor
+
+
+def _lookahead(generator):
+    # Raw predictions of the next horizon, computed on the inference executor
+    windows = generator.windows()
+    predictions = forecast_windows([(model, frame) for _, model, frame in windows])
+    return {key: prediction for (key, _, _), prediction in zip(windows, predictions)}
+
+
+def _prefetch(generator) -> None:
+    """
+    Starts the prediction of the next horizon in the background once the
+    samples left drop to the low-water mark. The windows do not change until
+    the next predict(), so the result is the same as a prediction made when
+    the samples are exhausted.
+    """
+    low_water = generator.inf_args.lookahead
+    if low_water is None or generator.det_sensor or generator._future is not None or generator.count > low_water:
+        return
+    generator._future = inference_executor().submit(_lookahead, generator)
+
+
+def _prefetched(generator):
+    """Returns the look-ahead predictions of the generator (waiting for them if needed), None if there are none."""
+    future, generator._future = generator._future, None
+    return future.result() if future is not None else None
+
+
+def predict_generators(generators):
+    """
+    Tick-level scheduler of the simulation. Collects the windows of all the
+    generators whose samples are exhausted, across machineries and sensors,
+    runs the models once for each group of windows sharing the same weights
+    and hands every generator its predictions, so their next get_values()
+    calls do not run any model.
+
+    Args:
+        generators (list): Generate and GeneratePlc objects.
+    """
+    # The generators with a look-ahead prediction in flight use it in get_values()
+    due = [generator for generator in generators if generator.count <= 0 and generator._future is None]
+    windows = [(generator, key, model, frame) for generator in due for key, model, frame in generator.windows()]
+    with quiet_lightning():
+        predictions = forecast_windows([(model, frame) for _, _, model, frame in windows])
+
+    by_generator = {id(generator): {} for generator in due}
+    for (generator, key, _, _), prediction in zip(windows, predictions):
+        by_generator[id(generator)][key] = prediction
+    for generator in due:
+        generator.predict(by_generator[id(generator)])
+
+
+class EncoderBuffer:
+    """
+    This class have been designed to hold the encoder window of a generator,
+    the time_idx, value, day and date of the last samples, in preallocated
+    NumPy arrays. Each array has twice the window length and every sample is
+    written in both halves, so the window is always a contiguous view in
+    chronological order and appending a sample does not allocate anything.
+    The mean and the variance of the window are updated as the samples enter
+    and leave it, so std() does not read the window.
+    
+    
+    Methods:
+        append(time_idx, value, day, date):
+            Adds a sample, the oldest one leaves the window when it is full.
+        round():
+            Rounds the values in place (int sensors).
+        row(position):
+            Returns the time_idx, value and day of a sample of the window.
+        std():
+            Standard deviation of the values in the window, O(1).
+        frame():
+            Materializes the window as a DataFrame for the model.
+    """
+    def __init__(
+            self,
+            encoder_data,
+            value_name: str,
+            length: int
+            ):
+        """
+        Initialize a new instance of EncoderBuffer.
+        
+        Args:
+            encoder_data (pd.DataFrame): first window with time_idx, value and day columns.
+            value_name (str): name of the value column (the head or 'value').
+            length (int): number of samples in the window (max_encoder_length).
+        """
+        self.value_name = value_name
+        self.length = length
+        self._time_idx = np.zeros(2 * length, dtype=np.int64)
+        self._values = np.zeros(2 * length, dtype=np.float64)
+        self._days = np.zeros(2 * length, dtype=np.int64)
+        self._dates = np.zeros(2 * length, dtype=np.int64)
+        self._labels = []
+        self._codes = {}
+        self._head = 0
+        self.size = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._run = 0
+        
+        encoder_data = encoder_data.iloc[-length:]
+        for time_idx, value, day, date in zip(encoder_data['time_idx'].to_numpy(), encoder_data[value_name].to_numpy(),
+                                              encoder_data['day'].astype(str), encoder_data.index):
+            self.append(time_idx, value, day, date)
+    
+    def append(self, time_idx, value, day, date) -> None:
+        """
+        Args:
+            time_idx (int): time index of the sample.
+            value (float): value of the sample.
+            day (str): day category of the sample.
+            date (pd.Timestamp): timestamp of the sample.
+        """
+        code = self._codes.get(day)
+        if code is None:
+            code = self._codes[day] = len(self._labels)
+            self._labels.append(day)
+        value = float(value)
+        self._update_stats(value)
+        for pos in (self._head, self._head + self.length):
+            self._time_idx[pos] = time_idx
+            self._values[pos] = value
+            self._days[pos] = code
+            self._dates[pos] = date.value
+        self._head = (self._head + 1) % self.length
+        self.size = min(self.size + 1, self.length)
+        if self._head == 0:
+            # Once per turn of the window the statistics are recomputed, so the rounding errors do not add up
+            self._sync_stats()
+    
+    def _update_stats(self, value):
+        # Welford update, the oldest sample leaves the window when it is full
+        newest = self._values[self._head + self.length - 1]
+        self._run = self._run + 1 if self.size > 0 and value == newest else 1
+        if self.size < self.length:
+            delta = value - self._mean
+            self._mean += delta / (self.size + 1)
+            self._m2 += delta * (value - self._mean)
+        else:
+            oldest = self._values[self._head]
+            mean = self._mean + (value - oldest) / self.length
+            self._m2 += (value - oldest) * (value - mean + oldest - self._mean)
+            self._mean = mean
+    
+    def _sync_stats(self):
+        values = self._values[self._window()]
+        self._mean = values.mean() if len(values) else 0.0
+        self._m2 = ((values - self._mean) ** 2).sum()
+        # Number of newest samples equal to the last one, the window is constant when it covers it
+        changes = np.flatnonzero(values != values[-1]) if len(values) else []
+        self._run = len(values) - (changes[-1] + 1 if len(changes) else 0)
+    
+    def _window(self):
+        return slice(self._head + self.length - self.size, self._head + self.length)
+    
+    def round(self) -> None:
+        np.round(self._values, 0, out=self._values)
+        self._sync_stats()
+    
+    def row(self, position):
+        """
+        Args:
+            position (int): negative position from the end of the window.
+        
+        Returns:
+            tuple: time_idx, value and day of the sample.
+        """
+        pos = self._head + self.length + position
+        return self._time_idx[pos], self._values[pos], self._labels[self._days[pos]]
+    
+    def std(self):
+        # Sample standard deviation (ddof=1), exactly 0 when all the values are equal
+        if self.size < 2:
+            return np.nan
+        if self._run >= self.size:
+            return np.float64(0.0)
+        return np.float64(np.sqrt(max(self._m2, 0.0) / (self.size - 1)))
+    
+    def frame(self) -> pd.DataFrame:
+        """
+        Returns:
+            pd.DataFrame: copy of the window with time_idx, value and day columns.
+        """
+        window = self._window()
+        labels = np.asarray(self._labels, dtype=object)
+        return pd.DataFrame({
+                'time_idx': self._time_idx[window].copy(),
+                self.value_name: self._values[window].copy(),
+                'day': pd.Categorical(labels[self._days[window]]),
+            },
+            index=pd.DatetimeIndex(self._dates[window].astype('datetime64[ns]'))
+        )
+
 class Generate:
     """
     This class have been designed to for generating artificial samples. In each
@@ -22,7 +317,9 @@ class Generate:
     
     
     Methods:
-        predict():
+        windows():
+            Encoder windows and models of the samples to predict.
+        predict(predictions=None):
             Predicting the future correct samples.
         get_type():
             Type of original values (int pr float)
@@ -36,6 +333,10 @@ class Generate:
         metadata,
         type_pickle: str = './pickles/type_sensors.pickle',
         det_pickle: str = './pickles/det_sensors.pickle',
+        compact: bool = False,
+        lookahead: int = None,
+        backend: str = 'checkpoint',
+        quantize: bool = False,
     ):
         """
         Initialize a new instance of Generate.
@@ -44,6 +345,16 @@ class Generate:
             metadata (dict): dictionary of the sensors metadata
             type_pickle (str): type of sensors generated from det.py
             det_pickle (str): deterministic sensors generated from det.py
+            compact (bool): whether to downcast the training frames (float32 or
+                            the smallest int type, following type_pickle)
+            lookahead (int): low-water mark of the look-ahead mode, the next
+                             samples are predicted in the background once the
+                             samples left drop to it. None to predict on demand
+            backend (str): 'checkpoint' or 'torchscript', see ModelRegistry.get()
+            quantize (bool): whether to run the int8 models, when their
+                             accuracy check passed, see Trainer.load_model().
+                             It halves their memory but makes the ticks
+                             slower, it is not a speed option
             device (str): which device we should use for prediction
         """
         
@@ -54,7 +365,7 @@ class Generate:
             self.det = pickle.load(handle)
                     
         self.sensor = metadata['sensor']
-        self.inf_args = InferArgs(category=self.sensor['category'], sensor=self.sensor['name'], machinery=metadata['machinery_uid'])
+        self.inf_args = InferArgs(category=self.sensor['category'], sensor=self.sensor['name'], machinery=metadata['machinery_uid'], compact=compact, lookahead=lookahead, backend=backend, quantize=quantize)
         self.train_args = TrainArgs(target='Head_01')
         self.device = self.train_args.accelerator
         self.heads = [f'Head_{i:>02}' for i in self.sensor['heads']]
@@ -66,6 +377,8 @@ class Generate:
         self._set_train_data()
         self._set_first_encoder_data()
         self.count = 0
+        self.multi_head = False
+        self._future = None
         if not self.det_sensor:
             self._set_model()
             
@@ -90,14 +403,19 @@ class Generate:
           self,
           
     ):
-        extract_obj = Extract(self.data_obj.sensors, self.inf_args.category, self.inf_args.machinery)
-        _ = extract_obj.get_raw_data()
-        extracted_data = extract_obj.extract_raw_data()
-        pre_data, self.det_sensors = extract_obj.preprocess_data(extracted_data)
-        filled_df = extract_obj.fill_data(extracted_data, self.det_sensors)
+        filled_df, self.det_sensors = registry.get(
+            Extract,
+            self.data_obj.sensors,
+            self.inf_args.category,
+            self.inf_args.machinery,
+            reader=self.inf_args.reader,
+            cache_dir=self.inf_args.cache_dir,
+            types=self.sen[self.inf_args.category] if self.inf_args.compact else None,
+            tail=self.train_args.max_encoder_length
+        )
 
         self.data_obj.load_data(filled_df)
-        self.train_data = self.data_obj.get_sensor(self.inf_args.sensor)
+        self.train_data = self.data_obj.get_sensor(self.inf_args.sensor, tail=self.train_args.max_encoder_length)
         self.train_data = self.train_data[~self.train_data.index.duplicated(keep='first')]
         if not self.det_sensor:
             for var in self.heads:
@@ -108,11 +426,17 @@ class Generate:
     def _set_model(
         self
     ):
+        # The models are shared with the other generators of the process
+        path = f'./checkpoints/{self.inf_args.machinery}/{self.inf_args.category}/heads/{self.inf_args.sensor}.ckpt'
+        self.multi_head = os.path.exists(path)
+        if self.multi_head:
+            # Sensor trained with TrainArgs.multi_head, one model for all the heads
+            model = models.get(path, self.device, self.inf_args.backend, self.inf_args.quantize, self.inf_args.quantize_tolerance)
+            self.model_heads = {head: model for head in self.heads}
+            return
         self.model_heads = {}
         for head in self.heads:
-            self.model = Trainer(device=self.device)
-            self.model.load_model(f'./checkpoints/{self.inf_args.machinery}/{self.inf_args.category}/{head}/{self.inf_args.sensor}.ckpt')
-            self.model_heads[head] = copy.deepcopy(self.model)
+            self.model_heads[head] = models.get(f'./checkpoints/{self.inf_args.machinery}/{self.inf_args.category}/{head}/{self.inf_args.sensor}.ckpt', self.device, self.inf_args.backend, self.inf_args.quantize, self.inf_args.quantize_tolerance)
             
         
     def _set_first_encoder_data(
@@ -120,77 +444,72 @@ class Generate:
     ):
         self.encoder_data = {}
         for head in self.heads:
-            self.encoder_data[head] = self.train_data[lambda x: x.time_idx > x.time_idx.max() - self.train_args.max_encoder_length][['time_idx',head,'day']]
+            window = self.train_data[lambda x: x.time_idx > x.time_idx.max() - self.train_args.max_encoder_length][['time_idx',head,'day']]
+            self.encoder_data[head] = EncoderBuffer(window, head, self.train_args.max_encoder_length)
         
-        self._date_idx = self.encoder_data[head].index[-1]
+        self._date_idx = window.index[-1]
         self._day = self._date_idx.day
+        self._day_label = str(self._day)
         self._new_date = self._date_idx + pd.Timedelta(days=1)
-        self._new_time_idx = self.encoder_data[head][['time_idx']].values[-1]  + 1
+        self._new_time_idx = int(window['time_idx'].values[-1]) + 1
         
         
     def _update_encoder_input(
-          self      
+          self,
+          values
     ): 
         
         for head in self.heads:
-            copy_date = copy.deepcopy(self._new_date)
-            copy_idx = copy.deepcopy(self._new_time_idx)
+            buffer = self.encoder_data[head]
             for i in range(self.train_args.max_prediction_length):
-                row = pd.DataFrame([{'time_idx':int(copy_idx[0]), head:float(self.pred_heads[head][i]),'day':str(self._day)}],index=[copy_date], columns=self.encoder_data[head].columns)
-                row.day = row.day.astype('category')
-                self.encoder_data[head] = self.encoder_data[head].append(row)
-                copy_date = copy_date + pd.Timedelta(seconds=1)
-                copy_idx += 1
-                
+                buffer.append(self._new_time_idx + i, float(values[head][i]), self._day_label, self._new_date + pd.Timedelta(seconds=i))
+            if self.sen[self.inf_args.category][self.inf_args.sensor]==int:
+                buffer.round()
 
         self._new_date = self._new_date + pd.Timedelta(seconds=self.train_args.max_prediction_length)
         self._new_time_idx = self._new_time_idx + self.train_args.max_prediction_length
-        for head in self.heads:
-            self.encoder_data[head] = self.encoder_data[head][lambda x: x.time_idx > x.time_idx.max() - self.train_args.max_encoder_length][['time_idx',head,'day']]
-            self.encoder_data[head].day = self.encoder_data[head].day.astype('category')
-            if self.sen[self.inf_args.category][self.inf_args.sensor]==int:
-                self.encoder_data[head][head] = self.encoder_data[head][head].round(0)
             
         
+    def windows(
+        self,
+    ):
+        """
+        Returns:
+            list: (head, Trainer, window frame) of every head to predict, empty
+            for deterministic sensors.
+        """
+        if self.det_sensor:
+            return []
+        if self.multi_head:
+            return [(head, self.model_heads[head], self.encoder_data[head].frame().assign(head=head)) for head in self.heads]
+        return [(head, self.model_heads[head], self.encoder_data[head].frame()) for head in self.heads]
+    
     def predict(
-        self,        
+        self,
+        predictions=None,
     ):
         """
         This predicts new samples
+        
+        Args:
+            predictions (dict): raw predictions of the windows() heads, as
+                computed by predict_generators(). None to run the models here.
         """
-        logging.disable(sys.maxsize)
         self.pred_heads = {}
         if not self.det_sensor:
+            if predictions is None:
+                # One forward pass for every group of heads sharing the same weights
+                windows = self.windows()
+                with quiet_lightning():
+                    predictions = dict(zip(self.heads, forecast_windows([(model, frame) for _, model, frame in windows])))
             for head in self.heads:
-                with open(os.devnull, "w") as f, contextlib.redirect_stdout(f):
-                    raw_prediction = self.model_heads[head].predict(
-                        self.encoder_data[head],
-                        plot=False
-                    )
-                    
-                self.pred_heads[head] = raw_prediction.output.prediction[:,3,1:6].squeeze(0).squeeze(0)
-            self._update_encoder_input()
+                self.pred_heads[head] = predictions[head][:,3,1:6].squeeze(0).squeeze(0)
+            self._update_encoder_input(self.pred_heads)
         
         else:
-            for head in self.heads:
-                copy_date = copy.deepcopy(self._new_date)
-                copy_idx = copy.deepcopy(self._new_time_idx)
-                for i in range(self.train_args.max_prediction_length):
-                    row = pd.DataFrame([{'time_idx':int(copy_idx[0]), head:float(self.det[self.sensor['category']][self.sensor['name']][head]),'day':str(self._day)}],index=[copy_date], columns=self.encoder_data[head].columns)
-                    row.day = row.day.astype('category')
-                    self.encoder_data[head] = self.encoder_data[head].append(row)
-                    copy_date = copy_date + pd.Timedelta(seconds=1)
-                    copy_idx = copy_idx + 1
-                    
-            self._new_date = self._new_date + pd.Timedelta(seconds=self.train_args.max_prediction_length)
-            self._new_time_idx = self._new_time_idx + self.train_args.max_prediction_length
-            for head in self.heads:
-                self.encoder_data[head] = self.encoder_data[head][lambda x: x.time_idx > x.time_idx.max() - self.train_args.max_encoder_length][['time_idx',head,'day']]
-                self.encoder_data[head].day = self.encoder_data[head].day.astype('category')
-                if self.sen[self.inf_args.category][self.inf_args.sensor]==int:
-                    self.encoder_data[head][head] = self.encoder_data[head][head].round(0)
+            det_values = self.det[self.sensor['category']][self.sensor['name']]
+            self._update_encoder_input({head: [det_values[head]] * self.train_args.max_prediction_length for head in self.heads})
                     
-        logging.disable(logging.NOTSET) 
         self.count = copy.deepcopy(self.train_args.max_prediction_length)
                 
     
@@ -209,18 +528,19 @@ class Generate:
             dict: dictionary of predicted values
         """
         if self.count<=0:
-            self.predict()
+            self.predict(_prefetched(self))
             
         values = {}
         now = pd.Timestamp.now()
         for head in self.heads:
-            values[head] = self.encoder_data[head].iloc[-self.count]
+            time_idx, value, day = self.encoder_data[head].row(-self.count)
             if self.sensor['name']=='AverageFriction':
-                values[head][head] = -values[head][head]
-            values[head].name = now
+                value = -value
             if self.sen[self.inf_args.category][self.inf_args.sensor]==int:
-                values[head][head] = values[head][head].astype("int")
+                value = value.astype("int")
+            values[head] = _sample(time_idx, head, value, day, now)
         self.count -= 1
+        _prefetch(self)
         return values
     
     def gen_fault(
@@ -237,27 +557,21 @@ class Generate:
             dict: dictionary of predicted fault values.
         """
 
-        values = {}
         now = pd.Timestamp.now()
-        for head in self.heads:
-            values[head] = self.encoder_data[head].iloc[-1]
-            if not self.det_sensor:
-                std = self.encoder_data[head][head].std()
-                if std==0:
-                    values[head][head] = values[head][head] + bias_percent*values[head][head]
-                else:
-                    values[head][head] = values[head][head] + std*(std_param+random.uniform(0,1))
-                
-                if self.sen[self.inf_args.category][self.inf_args.sensor]==int:
-                    values[head][head] = values[head][head].round(0)
-                    
-            values[head].name = now
-            if self.sensor['name']=='AverageFriction':
-                values[head][head] = -values[head][head]
+        time_idx, value, day = zip(*[self.encoder_data[head].row(-1) for head in self.heads])
+        value = np.array(value)
+        if not self.det_sensor:
+            std = np.array([self.encoder_data[head].std() for head in self.heads])
+            value = fault_values(value, std, std_param, bias_percent)
             if self.sen[self.inf_args.category][self.inf_args.sensor]==int:
-                values[head][head] = values[head][head].astype("int")
+                value = value.round(0)
+                
+        if self.sensor['name']=='AverageFriction':
+            value = -value
+        if self.sen[self.inf_args.category][self.inf_args.sensor]==int:
+            value = value.astype("int")
 
-        return values
+        return {head: _sample(time_idx[i], head, value[i], day[i], now) for i, head in enumerate(self.heads)}
     
     
     
@@ -269,7 +583,9 @@ class GeneratePlc:
     
     
     Methods:
-        predict():
+        windows():
+            Encoder windows and models of the samples to predict.
+        predict(predictions=None):
             Predicting the future correct samples.
         get_type():
             Type of original values (int pr float)
@@ -283,6 +599,10 @@ class GeneratePlc:
         metadata,
         type_pickle: str = './pickles/type_sensors.pickle',
         det_pickle: str = './pickles/det_sensors.pickle',
+        compact: bool = False,
+        lookahead: int = None,
+        backend: str = 'checkpoint',
+        quantize: bool = False,
     ):
         """
         Initialize a new instance of Generate.
@@ -291,6 +611,16 @@ class GeneratePlc:
             metadata (dict): dictionary of the sensors metadata
             type_pickle (str): type of sensors generated from det.py
             det_pickle (str): deterministic sensors generated from det.py
+            compact (bool): whether to downcast the training frames (float32 or
+                            the smallest int type, following type_pickle)
+            lookahead (int): low-water mark of the look-ahead mode, the next
+                             samples are predicted in the background once the
+                             samples left drop to it. None to predict on demand
+            backend (str): 'checkpoint' or 'torchscript', see ModelRegistry.get()
+            quantize (bool): whether to run the int8 models, when their
+                             accuracy check passed, see Trainer.load_model().
+                             It halves their memory but makes the ticks
+                             slower, it is not a speed option
             device (str): which device we should use for prediction
         """
         self.metadata = metadata
@@ -300,7 +630,7 @@ class GeneratePlc:
             self.det = pickle.load(handle)
                     
         self.sensor = metadata['sensor']
-        self.inf_args = InferArgs(category=self.sensor['category'], sensor=self.sensor['name'], machinery=metadata['machinery_uid'])
+        self.inf_args = InferArgs(category=self.sensor['category'], sensor=self.sensor['name'], machinery=metadata['machinery_uid'], compact=compact, lookahead=lookahead, backend=backend, quantize=quantize)
         self.train_args = TrainArgs(target='value')
         self.device = self.train_args.accelerator
         if self.sensor['name'] in self.det[self.sensor['category']].keys():
@@ -313,6 +643,7 @@ class GeneratePlc:
         self._set_first_encoder_data()
         self.count = 0
         self.det_count = 0
+        self._future = None
         if not self.det_sensor:
             self._set_model()
             
@@ -333,14 +664,19 @@ class GeneratePlc:
           self,
           
     ):
-        extract_obj = ExtractPlc(self.data_obj.sensors, self.inf_args.category, self.inf_args.machinery)
-        _ = extract_obj.get_raw_data()
-        extracted_data = extract_obj.extract_raw_data()
-        pre_data, self.det_sensors = extract_obj.preprocess_data(extracted_data)
-        filled_df = extract_obj.fill_data(extracted_data, self.det_sensors)
+        filled_df, self.det_sensors = registry.get(
+            ExtractPlc,
+            self.data_obj.sensors,
+            self.inf_args.category,
+            self.inf_args.machinery,
+            reader=self.inf_args.reader,
+            cache_dir=self.inf_args.cache_dir,
+            types=self.sen[self.inf_args.category] if self.inf_args.compact else None,
+            tail=self.train_args.max_encoder_length
+        )
 
         self.data_obj.load_data(filled_df)
-        self.train_data = self.data_obj.get_sensor(self.inf_args.sensor)
+        self.train_data = self.data_obj.get_sensor(self.inf_args.sensor, tail=self.train_args.max_encoder_length)
         self.train_data = self.train_data[~self.train_data.index.duplicated(keep='first')]
         if not self.det_sensor:
             self.train_data['value'] = self.train_data['value'].abs()
@@ -350,62 +686,69 @@ class GeneratePlc:
     def _set_model(
         self
     ):
-        self.model = Trainer(device = self.device)
-        self.model.load_model(f'./checkpoints/{self.inf_args.machinery}/{self.inf_args.category}/value/{self.inf_args.sensor}.ckpt')
+        self.model = models.get(f'./checkpoints/{self.inf_args.machinery}/{self.inf_args.category}/value/{self.inf_args.sensor}.ckpt', self.device, self.inf_args.backend, self.inf_args.quantize, self.inf_args.quantize_tolerance)
             
         
     def _set_first_encoder_data(
         self,
     ):
         
-        self.encoder_data = self.train_data[lambda x: x.time_idx > x.time_idx.max() - self.train_args.max_encoder_length][['time_idx','value','day']]
+        window = self.train_data[lambda x: x.time_idx > x.time_idx.max() - self.train_args.max_encoder_length][['time_idx','value','day']]
+        self.encoder_data = EncoderBuffer(window, 'value', self.train_args.max_encoder_length)
         
-        self._date_idx = self.encoder_data.index[-1]
+        self._date_idx = window.index[-1]
         self._day = self._date_idx.day
+        self._day_label = str(self._day)
         self._new_date = self._date_idx + pd.Timedelta(days=1)
-        self._new_time_idx = self.encoder_data[['time_idx']].values[-1]  + 1
+        self._new_time_idx = int(window['time_idx'].values[-1]) + 1
         
         
     def _update_encoder_input(
-          self      
+          self,
+          values
     ): 
         
-        copy_date = copy.deepcopy(self._new_date)
-        copy_idx = copy.deepcopy(self._new_time_idx)
         for i in range(self.train_args.max_prediction_length):
-            row = pd.DataFrame([{'time_idx':int(copy_idx[0]), "value":float(self.pred[i]),'day':str(self._day)}],index=[copy_date], columns=self.encoder_data.columns)
-            row.day = row.day.astype('category')
-            self.encoder_data = self.encoder_data.append(row)
-            copy_date = copy_date + pd.Timedelta(seconds=1)
-            copy_idx += 1
-                
+            self.encoder_data.append(self._new_time_idx + i, float(values[i]), self._day_label, self._new_date + pd.Timedelta(seconds=i))
+        if self.sen[self.inf_args.category][self.inf_args.sensor]==int:
+            self.encoder_data.round()
 
         self._new_date = self._new_date + pd.Timedelta(seconds=self.train_args.max_prediction_length)
         self._new_time_idx = self._new_time_idx + self.train_args.max_prediction_length
-        
-        self.encoder_data = self.encoder_data[lambda x: x.time_idx > x.time_idx.max() - self.train_args.max_encoder_length][['time_idx','value','day']]
-        self.encoder_data.day = self.encoder_data.day.astype('category')
-        if self.sen[self.inf_args.category][self.inf_args.sensor]==int:
-            self.encoder_data['value'] = self.encoder_data['value'].round(0)
             
         
+    def windows(
+        self,
+    ):
+        """
+        Returns:
+            list: ('value', Trainer, window frame) of the sensor, empty for
+            deterministic sensors.
+        """
+        if self.det_sensor:
+            return []
+        return [('value', self.model, self.encoder_data.frame())]
+    
     def predict(
-        self,        
+        self,
+        predictions=None,
     ):
-        logging.disable(sys.maxsize)
+        """
+        Args:
+            predictions (dict): raw prediction of the windows() entry, as
+                computed by predict_generators(). None to run the model here.
+        """
         self.pred = {}
         if not self.det_sensor:
-            with open(os.devnull, "w") as f, contextlib.redirect_stdout(f):
-                raw_prediction = self.model.predict(
-                    self.encoder_data,
-                    plot=False
-                )
-            self.pred = raw_prediction.output.prediction[:,3,1:6].squeeze(0).squeeze(0)
-            self._update_encoder_input()
+            if predictions is None:
+                _, model, frame = self.windows()[0]
+                with quiet_lightning():
+                    predictions = {'value': forecast_windows([(model, frame)])[0]}
+            self.pred = predictions['value'][:,3,1:6].squeeze(0).squeeze(0)
+            self._update_encoder_input(self.pred)
         
         else:
-            copy_date = copy.deepcopy(self._new_date)
-            copy_idx = copy.deepcopy(self._new_time_idx)
+            det_values = []
             self.total_product = None
             for i in range(self.train_args.max_prediction_length):
                 if len(self.det[self.sensor['category']][self.sensor['name']]['value'])==1:
@@ -423,21 +766,9 @@ class GeneratePlc:
                     self.det_count+=1
                     if self.det_count==len(self.det[self.sensor['category']][self.sensor['name']]['value']):
                         self.det_count = 0
-                        
-                row = pd.DataFrame([{'time_idx':int(copy_idx[0]), 'value':float(value),'day':str(self._day)}],index=[copy_date], columns=self.encoder_data.columns)
-                row.day = row.day.astype('category')
-                self.encoder_data = self.encoder_data.append(row)
-                copy_date = copy_date + pd.Timedelta(seconds=1)
-                copy_idx = self.encoder_data[['time_idx']].values[-1]  + 1
-                    
-            self._new_date = self._new_date + pd.Timedelta(seconds=self.train_args.max_prediction_length)
-            self._new_time_idx = self._new_time_idx + self.train_args.max_prediction_length
-            self.encoder_data = self.encoder_data[lambda x: x.time_idx > x.time_idx.max() - self.train_args.max_encoder_length][['time_idx','value','day']]
-            self.encoder_data.day = self.encoder_data.day.astype('category')
-            if self.sen[self.inf_args.category][self.inf_args.sensor]==int:
-                self.encoder_data['value'] = self.encoder_data['value'].round(0)
+                det_values.append(value)
+            self._update_encoder_input(det_values)
                     
-        logging.disable(logging.NOTSET) 
         self.count = copy.deepcopy(self.train_args.max_prediction_length)
                 
     
@@ -457,14 +788,14 @@ class GeneratePlc:
         """
         
         if self.count==0:
-            self.predict()
+            self.predict(_prefetched(self))
             
-        value = self.encoder_data.iloc[-self.count]
-        value.name = pd.Timestamp.now() 
+        time_idx, value, day = self.encoder_data.row(-self.count)
         if self.sen[self.inf_args.category][self.inf_args.sensor]==int:
-            value['value'] = value['value'].astype("int")
+            value = value.astype("int")
         self.count -= 1
-        return value
+        _prefetch(self)
+        return _sample(time_idx, 'value', value, day, pd.Timestamp.now())
 
     def gen_fault(
         self,
@@ -480,16 +811,222 @@ class GeneratePlc:
             dict: dictionary of predicted fault values.
         """
         
-        value = self.encoder_data.iloc[-1]
+        time_idx, value, day = self.encoder_data.row(-1)
         if not self.det_sensor:
-            std = self.encoder_data['value'].std()
-            if std==0:
-                value['value'] = value['value'] + bias_percent*value['value']
-            else:
-                value['value'] = value['value'] + std*(std_param+random.uniform(0,1))
+            value = fault_values(np.array([value]), np.array([self.encoder_data.std()]), std_param, bias_percent)[0]
             
         if self.sen[self.inf_args.category][self.inf_args.sensor]==int:
-            value['value'] = value['value'].astype("int")
+            value = value.astype("int")
             
-        value.name = pd.Timestamp.now()  
-        return value
\ No newline at end of file
+        return _sample(time_idx, 'value', value, day, pd.Timestamp.now())
+
+
+
+class GenerateDet:
+    """
+    This class have been designed to generate the samples of the
+    deterministic sensors of det.py, of any category. It emits the same
+    samples as Generate() and GeneratePlc() for these sensors, but the values
+    come from a cycle precomputed at initialization (a constant, the counter
+    of TotalProduct or the states of the sensors with several values) and
+    the samples are Sample dictionaries, so a tick builds no pandas object
+    besides the timestamp, taken with pd.Timestamp.now() as in the other
+    generators. It accepts the options of make_generator() like the other
+    generators, but only compact is used: lookahead, backend and quantize
+    are ignored, since no model runs.
+
+
+    Methods:
+        windows():
+            No model runs for the deterministic sensors, always empty.
+        predict(predictions=None):
+            Moves to the next horizon of samples.
+        get_type():
+            Type of original values (int pr float)
+        get_values():
+            get the next values.
+        gen_fault():
+            get the fault samples, the last values of the horizon.
+    """
+    def __init__(
+        self,
+        metadata,
+        type_pickle: str = './pickles/type_sensors.pickle',
+        det_pickle: str = './pickles/det_sensors.pickle',
+        compact: bool = False,
+        lookahead: int = None,
+        backend: str = 'checkpoint',
+        quantize: bool = False,
+    ):
+        """
+        Initialize a new instance of GenerateDet.
+
+        Args:
+            metadata (dict): dictionary of the sensors metadata
+            type_pickle (str): type of sensors generated from det.py
+            det_pickle (str): deterministic sensors generated from det.py
+            compact (bool): whether to downcast the training frames
+            lookahead (int): accepted for compatibility with the other
+                             generators, nothing is predicted in the background
+            backend (str): accepted for compatibility with the other
+                           generators, no model is loaded
+            quantize (bool): accepted for compatibility with the other
+                             generators, no model is loaded
+        """
+        with open(type_pickle, 'rb') as handle:
+            self.sen = pickle.load(handle)
+        with open(det_pickle, 'rb') as handle:
+            self.det = pickle.load(handle)
+
+        self.sensor = metadata['sensor']
+        self.inf_args = InferArgs(category=self.sensor['category'], sensor=self.sensor['name'], machinery=metadata['machinery_uid'], compact=compact, lookahead=lookahead, backend=backend, quantize=quantize)
+        self.train_args = TrainArgs(target='Head_01')
+        self.plc = self.inf_args.category == 'plc'
+        self.heads = ['value'] if self.plc else [f'Head_{i:>02}' for i in self.sensor['heads']]
+        self.det_sensor = True
+        self.count = 0
+        self._future = None
+        self._horizons = 0
+        self._set_last_sample()
+        self._set_cycles()
+
+    def _set_last_sample(self):
+        # Last training sample, the only one a sample can come from before the first horizon
+        if self.plc:
+            data_obj, extractor = PLC(heads=1, machinery=self.inf_args.machinery), ExtractPlc
+        elif self.inf_args.category == 'drive':
+            data_obj, extractor = DRIVE(heads=self.inf_args.heads, machinery=self.inf_args.machinery), Extract
+        else:
+            data_obj, extractor = EQTQ(heads=self.inf_args.heads, machinery=self.inf_args.machinery), Extract
+        data_obj.set_sensors(data_obj.all_sensors)
+        data_obj.set_unk_variables()
+        filled_df, _ = registry.get(
+            extractor,
+            data_obj.sensors,
+            self.inf_args.category,
+            self.inf_args.machinery,
+            reader=self.inf_args.reader,
+            cache_dir=self.inf_args.cache_dir,
+            types=self.sen[self.inf_args.category] if self.inf_args.compact else None,
+            tail=self.train_args.max_encoder_length
+        )
+        data_obj.load_data(filled_df)
+        train_data = data_obj.get_sensor(self.inf_args.sensor, tail=self.train_args.max_encoder_length)
+        train_data = train_data[~train_data.index.duplicated(keep='first')]
+
+        self._first_time_idx = int(train_data['time_idx'].to_numpy()[-1]) + 1
+        self._day_label = str(train_data.index[-1].day)
+        self._last = {head: np.float64(train_data[head].to_numpy()[-1]) for head in self.heads}
+
+    def _set_cycles(self):
+        # Values of the samples of each head, the k-th sample takes cycle[k % len(cycle)]
+        det_values = self.det[self.inf_args.category][self.inf_args.sensor]
+        if not self.plc:
+            self._cycles = {head: np.array([det_values[head]], dtype=np.float64) for head in self.heads}
+        elif len(det_values['value']) > 1:
+            self._cycles = {'value': np.array(det_values['value'], dtype=np.float64)}
+        elif self.inf_args.sensor == 'TotalProduct':
+            # The counter restarts from the deterministic value at every horizon
+            steps = 10 * np.arange(1, self.train_args.max_prediction_length + 1)
+            self._cycles = {'value': det_values['value'][0] + steps.astype(np.float64)}
+        else:
+            self._cycles = {'value': np.array(det_values['value'], dtype=np.float64)}
+        if self.get_type()==int:
+            self._cycles = {head: np.round(cycle, 0) for head, cycle in self._cycles.items()}
+
+    def _samples(self, time_idx, values, now):
+        # Same sign and type conversions as the sample methods of the other generators
+        samples = {}
+        for head, value in values.items():
+            if self.inf_args.sensor=='AverageFriction' and not self.plc:
+                value = -value
+            if self.get_type()==int:
+                value = value.astype("int")
+            samples[head] = Sample(np.int64(time_idx), head, value, self._day_label, now)
+        return samples['value'] if self.plc else samples
+
+    def _position(self, position, now):
+        # Samples of all the heads at a position of the generated stream
+        values = {head: cycle[position % len(cycle)] for head, cycle in self._cycles.items()}
+        return self._samples(self._first_time_idx + position, values, now)
+
+    def windows(
+        self,
+    ):
+        """
+        Returns:
+            list: always empty, no model runs for the deterministic sensors.
+        """
+        return []
+
+    def predict(
+        self,
+        predictions=None,
+    ):
+        """
+        Args:
+            predictions (dict): ignored, the values are deterministic.
+        """
+        self._horizons += 1
+        self.count = self.train_args.max_prediction_length
+
+    def get_type(self):
+        """
+        Returns:
+            str: whether int or float
+        """
+        return self.sen[self.inf_args.category][self.inf_args.sensor]
+
+    def get_values(
+         self
+    ):
+        """
+        Returns:
+            dict: dictionary of the values of the heads (the sample for the plc sensors)
+        """
+        if self.count<=0:
+            self.predict()
+        position = self._horizons * self.train_args.max_prediction_length - self.count
+        self.count -= 1
+        return self._position(position, pd.Timestamp.now())
+
+    def gen_fault(
+        self,
+        std_param=3,
+        bias_percent=0.1
+    ):
+        """
+        As in the other generators the fault of a deterministic sensor is the
+        last value of the current horizon, without any noise.
+
+        Args:
+            std_param (int): not used for the deterministic sensors.
+            bias_percent (float): not used for the deterministic sensors.
+
+        Returns:
+            dict: dictionary of the fault values of the heads (the sample for the plc sensors)
+        """
+        if self._horizons == 0:
+            return self._samples(self._first_time_idx - 1, self._last, pd.Timestamp.now())
+        return self._position(self._horizons * self.train_args.max_prediction_length - 1, pd.Timestamp.now())
+
+
+def make_generator(metadata, det_pickle: str = './pickles/det_sensors.pickle', **kwargs):
+    """
+    Returns the generator of a sensor, GenerateDet() for the deterministic
+    sensors of det.py, GeneratePlc() for the plc sensors and Generate() for
+    the others.
+
+    Args:
+        metadata (dict): dictionary of the sensors metadata.
+        det_pickle (str): deterministic sensors generated from det.py.
+        kwargs: other arguments of the generator.
+    """
+    with open(det_pickle, 'rb') as handle:
+        det = pickle.load(handle)
+    sensor = metadata['sensor']
+    if sensor['name'] in det[sensor['category']]:
+        return GenerateDet(metadata, det_pickle=det_pickle, **kwargs)
+    if sensor['category']=='plc':
+        return GeneratePlc(metadata, det_pickle=det_pickle, **kwargs)
+    return Generate(metadata, det_pickle=det_pickle, **kwargs)
@@ -1,17 +1,187 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
 import pandas as pd
-import plotly.io as pio
-import plotly.express as px
-import plotly.graph_objects as go
-import matplotlib.pyplot as plt
 import warnings
 import os
 import json
-import copy
+import time
+import hashlib
+import itertools
+import bson
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from modules.cache import FrameCache
 warnings.filterwarnings("ignore")
 
 
+def _category_path(data_path, category, reader):
+    if reader == 'json':
+        return os.path.join(data_path, 'MongoData' + category.upper() +'.json')
+    elif reader == 'bson':
+        return os.path.join(data_path, category + '.bson')
+    raise ValueError(f'Unknown reader "{reader}", use "json" or "bson"')
+
+
+def _iter_json_array(path, chunk_size=1 << 16):
+    """
+    Yields the elements of a top-level json array one at a time. Only the
+    current document and the unread part of the chunk are held in memory.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as datafile:
+        buffer, pos = datafile.read(chunk_size).lstrip(), 1
+        if not buffer.startswith('['):
+            raise ValueError(f'{path} does not contain a json array')
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                doc, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The document continues in the next chunks
+                more = datafile.read(max(chunk_size, len(buffer) - pos))
+                if not more:
+                    raise
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            yield doc
+
+
+def _iter_documents(path, reader):
+    """
+    Yields the MongoDB documents of a category one at a time. The bson dumps
+    are decoded incrementally and their timestamps are already native numbers.
+    """
+    if reader == 'bson':
+        with open(path, 'rb') as datafile:
+            yield from bson.decode_file_iter(datafile)
+    else:
+        yield from _iter_json_array(path)
+
+
+def _read_documents(path, reader, keep=None):
+    """
+    Reads the MongoDB documents of a category. Documents rejected by keep
+    are skipped while reading.
+    """
+    documents = [doc for doc in _iter_documents(path, reader) if keep is None or keep(doc)]
+    if not documents:
+        raise ValueError(f'No documents of the selected machinery and heads in {path}')
+    return documents
+
+
+def _unwrap_time(time):
+    """
+    Converts the sample timestamps to int64 milliseconds. Extended json
+    timestamps ({"$numberLong": ...}) are unwrapped column-wise instead of
+    row by row.
+    """
+    if time.dtype == object and len(time) and isinstance(time.iloc[0], dict):
+        time = pd.DataFrame(time.tolist(), index=time.index).iloc[:, 0]
+    return time.astype('int64')
+
+
+def _daily_variance(frames):
+    """
+    Computes the variance of every column for each day of all the frames in
+    a single pass, instead of grouping every frame day by day.
+    
+    Args:
+        frames (dict): a dictionary containing sensors as keys and frames as values.
+    
+    Returns:
+        dict: for each sensor the days, the day code of each row and the
+              total variance of the columns in each day.
+    """
+    keys, values, layout = [], [], {}
+    offset = 0
+    for sensor, df in frames.items():
+        codes, days = pd.factorize(df.index.normalize(), sort=True)
+        data = df.to_numpy(dtype='float64')
+        rows, cols = np.nonzero(~np.isnan(data))
+        keys.append(offset + codes[rows] * data.shape[1] + cols)
+        values.append(data[rows, cols])
+        layout[sensor] = (offset, days, codes, data.shape[1])
+        offset += len(days) * data.shape[1]
+    if not layout:
+        return {}
+    
+    keys, values = np.concatenate(keys), np.concatenate(values)
+    count = np.bincount(keys, minlength=offset)
+    mean = np.bincount(keys, weights=values, minlength=offset) / np.maximum(count, 1)
+    squares = np.bincount(keys, weights=(values - mean[keys]) ** 2, minlength=offset)
+    # Columns with less than two samples in a day have no variance, like DataFrame.var()
+    var = np.where(count > 1, squares / np.maximum(count - 1, 1), 0.0)
+    
+    variance = {}
+    for sensor, (start, days, codes, n_cols) in layout.items():
+        day_var = var[start:start + len(days) * n_cols].reshape(len(days), n_cols).sum(axis=1)
+        variance[sensor] = (days, codes, day_var)
+    return variance
+
+
+def _select_days(df, codes, keep):
+    """
+    Returns the rows of the kept days, grouped day by day in the order of the days.
+    """
+    rows = np.flatnonzero(keep[codes])
+    return df.iloc[rows[np.argsort(codes[rows], kind='stable')]]
+
+
+def _fill_frame(df):
+    """
+    Interpolates the missing values of a frame and keeps the first complete
+    row of each timestamp, with a single row selection.
+    """
+    df = df.interpolate(method='linear')
+    rows = np.flatnonzero(df.notna().all(axis=1).to_numpy())
+    rows = rows[~df.index[rows].duplicated()]
+    return df.iloc[rows]
+
+
+def _fill_tail(df, tail):
+    """
+    Fills only the last tail rows that _fill_frame() would return. The rows
+    are interpolated from the last value of each head before the window, and
+    the number of rows before the window is stored in attrs['time_idx_offset'],
+    so the time indexes stay the same as with the whole history.
+    """
+    valid = df.notna().to_numpy()
+    if len(df) == 0 or not valid.any(axis=0).all():
+        filled = df.iloc[:0].copy()
+        filled.attrs['time_idx_offset'] = 0
+        return filled
+    # Rows before the first value of any head are dropped by _fill_frame()
+    start = valid.argmax(axis=0).max()
+    rows = start + np.flatnonzero(~df.index[start:].duplicated())
+    offset = max(len(rows) - tail, 0)
+    rows = rows[offset:]
+    lo = rows[0] - valid[:rows[0] + 1][::-1].argmax(axis=0).max()
+    
+    filled = df.iloc[lo:].interpolate(method='linear').iloc[rows - lo]
+    filled.attrs['time_idx_offset'] = offset
+    return filled
+
+
+def _compact_frame(df, sensor_type=None):
+    """
+    Downcasts the values of a filled frame. Float columns are stored as
+    float32, integer columns of int sensors as the smallest integer type
+    that holds their values (and their absolute values).
+    """
+    dtypes = {}
+    for col, dtype in df.dtypes.items():
+        if dtype.kind == 'f':
+            dtypes[col] = np.float32
+        elif dtype.kind == 'i' and sensor_type is int:
+            bound = int(np.abs(df[col].to_numpy()).max()) if len(df) else 0
+            dtypes[col] = next(t for t in (np.int8, np.int16, np.int32, np.int64) if np.iinfo(t).max >= bound)
+    return df.astype(dtypes) if dtypes else df
+
+
 class Extract:
     """
     This class have been designed to extract and transform raw data
@@ -25,8 +195,10 @@ class Extract:
             This is the first step to get the data based on heads and different sensors.
         preprocess_data(extr_df):
             Preprocesses the data to from original timestamps.
-        fill_data(df, det_sensors):
+        fill_data(df, det_sensors, inplace=False):
             Fill the NaN values in the DataFrame.
+        append_raw_data(path):
+            Merges a new raw data file into the frames (incremental only).
     """
     def __init__(
             self,
@@ -38,7 +210,13 @@ class Extract:
             figs_dir: str ='./figs',
             plt_style: str = 'Solarize_Light2',
             data_path: str = './data',
-            verbose: bool = True
+            verbose: bool = True,
+            reader: str = 'json',
+            cache_dir: str = None,
+            types: dict = None,
+            tail: int = None,
+            incremental: bool = False,
+            heads: list = None
             ):
 
         """
@@ -47,36 +225,54 @@ class Extract:
         Args:
             sensors (list): list of all sensors we want to analyze
             category (str): name of category ['eqtq', 'drive']
-            machinery (str): name of machinery
+            machinery (str): name of machinery, documents of other machineries are skipped
             show_fig (bool): whether to show the figs while extracting
             save_fig (bool): whether to save the figs while extracting
             figs_dir (str): figs directory.
             plt_style (str): plot styles.
             data_path (str): original data path of the sensors.
             verbose (bool): whether to print any information regarding extraction.
+            reader (str): format of the raw data files ['json', 'bson'].
+            cache_dir (str): directory of the extracted frames cache, None to disable it.
+            types (dict): types of the sensors (type_sensors.pickle of the category),
+                          the filled frames are downcast when given.
+            tail (int): number of trailing rows filled for each sensor, None to fill
+                        the whole history.
+            incremental (bool): whether to keep the extracted, preprocessed and
+                                filled frames for append_raw_data(). The three
+                                generations of every frame stay in memory.
+            heads (list): heads to load (e.g. ['Head_01']), None to load all of them
         """
         self.verbose = verbose
         self.figs_dir = figs_dir
         self.sensors = sensors.copy()
         self.machinery = machinery
+        self.heads = list(heads) if heads else None
         self.category = category
-        self.category_path = os.path.join(data_path, 'MongoData' + category.upper() +'.json')
+        self.reader = reader
+        self.category_path = _category_path(data_path, category, reader)
         self.raw_data = None
+        self.cache = FrameCache(cache_dir) if cache_dir else None
+        self.types = types
+        self.tail = tail
+        self.incremental = incremental
         self.verbose = verbose
         if show_fig: self._set_plt_style(plt_style)
         
     def _set_plt_style(self, plt_style):
+        import matplotlib.pyplot as plt
         plt.style.use(plt_style)
         
     
-    def _set_sensors_dict(self):
-        self.sensor_dict = {key: pd.DataFrame(columns=self.raw_data.folder.unique()) for key in self.sensors}
+    def _keep_document(self, doc):
+        # The original exports have no machinery_uid, their documents are always kept
+        if doc.get('machinery_uid', self.machinery) != self.machinery:
+            return False
+        return self.heads is None or doc.get('folder') in self.heads
         
     def _set_data(self):
         
-        with open(self.category_path, 'r') as datafile:
-            data = json.load(datafile)
-        self.raw_data = pd.DataFrame(data)
+        self.raw_data = pd.DataFrame(_read_documents(self.category_path, self.reader, self._keep_document))
         if self.verbose:
             print(f'\n{self.raw_data.folder.unique().shape[0]} heads and {len(self.sensors)} sensors detected in "{self.category}" sensor category.')
 
@@ -94,31 +290,95 @@ class Extract:
         Returns:
             dict: a dictionary containing all heads as values and sensors and keys
         """
+        if self.cache is not None:
+            key = self.cache.key(self.category_path, extractor=type(self).__name__, machinery=self.machinery, heads=self.heads)
+            cached = self.cache.load(key, self.sensors)
+            if cached is not None:
+                if self.verbose:
+                    print(f'Loaded {len(self.sensors)} sensors of "{self.category}" from cache.')
+                self.sensor_dict = cached
+                if self.incremental:
+                    self._extracted = dict(self.sensor_dict)
+                return self.sensor_dict
         
-        self._set_sensors_dict()
-        sensors_cpy = self.sensors.copy()
+        self._extract_raw_data()
+        if self.cache is not None:
+            self.cache.save(key, self.sensor_dict)
+        if self.incremental:
+            # preprocess_data() replaces the entries of the returned dictionary
+            self._extracted = dict(self.sensor_dict)
+        return self.sensor_dict
+        
+    def _stream_samples(self):
+        # The samples are appended to typed buffers while the documents are read,
+        # so neither the parsed documents nor self.raw_data are ever held in memory
+        heads, names = {}, {}
+        head_codes, name_codes = array('i'), array('i')
+        values, times = array('d'), array('q')
+        for doc in _iter_documents(self.category_path, self.reader):
+            if not self._keep_document(doc):
+                continue
+            head = heads.setdefault(doc['folder'], len(heads))
+            for sample in doc['samples']:
+                name, value, time = sample.get('name'), sample.get('value'), sample.get('time')
+                if name is None or value is None or time is None or value != value:
+                    continue
+                if isinstance(time, dict):
+                    time = next(iter(time.values()))
+                head_codes.append(head)
+                name_codes.append(names.setdefault(name, len(names)))
+                values.append(value)
+                times.append(int(time))
+        if not heads:
+            raise ValueError(f'No documents of the selected machinery and heads in {self.category_path}')
         if self.verbose:
-            print('Extracting raw data.')
+            print(f'\n{len(heads)} heads and {len(self.sensors)} sensors detected in "{self.category}" sensor category.')
+        
+        order = np.argsort(np.frombuffer(head_codes, dtype=np.int32), kind='stable')
+        samples = pd.DataFrame({
+            'name': pd.Categorical.from_codes(np.frombuffer(name_codes, dtype=np.int32)[order], categories=list(names)),
+            'value': np.frombuffer(values, dtype=np.float64)[order],
+            'time': np.frombuffer(times, dtype=np.int64)[order],
+            'folder': pd.Categorical.from_codes(np.frombuffer(head_codes, dtype=np.int32)[order], categories=list(heads)),
+        })
+        return samples, np.array(list(heads), dtype=object)
     
-        for head in self.raw_data.folder.unique():
-            df_head = pd.DataFrame(self.raw_data[self.raw_data.folder==head].samples.sum())
-            df_head = df_head.dropna()
-            # df_head.value = df_head.value.map(lambda x: float(x[list(x.keys())[0]]))
-            # We need to correct the timestamps
-            df_head.time = df_head.time.map(lambda x: int(x[list(x.keys())[0]]))
-            df_head.index = df_head.set_index('time').index.astype(int)/1000
-
-            df_head = df_head.drop_duplicates()
-            for sensor in sensors_cpy:
-                # In this function we try to understand the relationship between deifferent heads
-                # We delete the index, so we can join different heads, this is a prototype. 
-                df_by_sensor = df_head[df_head.name.str.contains(sensor)]
-                ins_df = pd.concat([self.sensor_dict[sensor], df_by_sensor.value.rename(head).to_frame()])
-                self.sensor_dict[sensor] = ins_df
-                
-        for sensor in sensors_cpy:     
-            self.sensor_dict[sensor] = self.sensor_dict[sensor].dropna(axis='columns', how='all').sort_index().rename(index={'time':'date'})
-            self.sensor_dict[sensor].index = pd.to_datetime(self.sensor_dict[sensor].index, unit='s')
+    def _samples_frame(self):
+        # One row per sample, in the order of the heads and of the documents
+        if self.raw_data is None:
+            return self._stream_samples()
+        heads = self.raw_data.folder.unique()
+        raw_data = self.raw_data[['folder', 'samples']]
+        raw_data = raw_data.iloc[np.argsort(pd.Categorical(raw_data.folder, categories=heads).codes, kind='stable')]
+        samples = pd.DataFrame(list(itertools.chain.from_iterable(raw_data.samples)))
+        samples['folder'] = np.repeat(raw_data.folder.to_numpy(), raw_data.samples.str.len().to_numpy())
+        return samples, heads
+    
+    def _extract_raw_data(self):
+        if self.verbose:
+            print('Extracting raw data.')
+        
+        samples, heads = self._samples_frame()
+        samples = samples.dropna()
+        samples['time'] = _unwrap_time(samples.time)
+        samples = samples.drop_duplicates()
+        # "H01_LockDegree" is split into the head prefix and the sensor name
+        names = pd.Categorical(samples.name)
+        samples['sensor'] = names.categories.str.split('_', n=1).str[1].to_numpy()[names.codes]
+        samples = samples[samples.sensor.isin(self.sensors)]
+        samples['head'] = pd.Categorical(samples.folder, categories=heads).codes
+        
+        groups = dict(tuple(samples.groupby('sensor', sort=False)))
+        self.sensor_dict = {}
+        for sensor in self.sensors:
+            # Each sample fills only the column of its own head, the other heads stay NaN
+            group = groups.get(sensor, samples.iloc[:0])
+            values = np.full((len(group), len(heads)), np.nan)
+            values[np.arange(len(group)), group['head'].to_numpy()] = group.value.to_numpy(dtype='float64')
+            df = pd.DataFrame(values, index=group.time.to_numpy() / 1000, columns=heads)
+            df = df.dropna(axis='columns', how='all').sort_index()
+            df.index = pd.to_datetime(df.index, unit='s')
+            self.sensor_dict[sensor] = df
                 
         return self.sensor_dict
     
@@ -135,23 +395,20 @@ class Extract:
         """
         deterministic_sensor = []
         new_df = extr_df
+        # The variance of each day is computed for all the sensors and heads at once
+        variance = _daily_variance({sensor: new_df[sensor] for sensor in self.sensors})
         for sensor in self.sensors:
-            # We group the data for each sensor based on the days
-            results = [group[1] for group in new_df[sensor].groupby(new_df[sensor].index.date)]
-            # result[2].interpolate(method='linear').plot(legend=False)
-            tot_var = 0
-            new_results = []
-            for result in results:
-                # We remove results that do not have sufficent variance in their heads. We catogorize them as deterministic sensors
-                tot_var += result.var().sum()
-                if result.var().sum() > 1e-1: new_results.append(result)
-            
-            if len(new_results)==0:
+            _, codes, day_var = variance[sensor]
+            # We remove days that do not have sufficent variance in their heads. We catogorize them as deterministic sensors
+            keep = day_var > 1e-1
+            if not keep.any():
                 if self.verbose:
-                    print(f'Sensor {sensor} has total variance of {tot_var} and is deterministic.')
+                    print(f'Sensor {sensor} has total variance of {day_var.sum()} and is deterministic.')
                 deterministic_sensor.append(sensor)
                 continue
-            new_df[sensor] = pd.concat(new_results)
+            new_df[sensor] = _select_days(new_df[sensor], codes, keep)
+        if self.incremental:
+            self._pre_data, self._det_sensors = dict(new_df), list(deterministic_sensor)
         return new_df, deterministic_sensor
     
     def _split_sensors(self, df, deterministic_sensor):
@@ -159,23 +416,129 @@ class Extract:
         new_sesnors = [sensor for sensor in self.sensors if sensor not in deterministic_sensor]
         return new_sesnors
         
+    def _fill_seam(self, pre, filled, start, end):
+        # Linear interpolation only looks at the closest valid values of each head,
+        # so only the rows between the last valid value before start and the
+        # first valid value after end can change. The rest is taken from filled.
+        index = pre.index
+        valid = pre.notna().to_numpy()
+        pos = np.arange(len(pre))[:, None]
+        lo = np.where(valid & (index < start)[:, None], pos, -1).max(axis=0)
+        hi = np.where(valid & (index >= end)[:, None], pos, len(pre) - 1).min(axis=0)
+        if lo.min() < 0:
+            # A head has no value before the new rows, the leading rows change
+            return _fill_frame(pre)
+        a, b = lo.min(), hi.max()
+        while a > 0 and index[a - 1] == index[a]:
+            a -= 1
+        while b < len(pre) - 1 and index[b + 1] == index[b]:
+            b += 1
+        
+        window = pre.iloc[a:b + 1].interpolate(method='linear')
+        rel = pos[a:b + 1]
+        outside = (rel < lo[None, :]) | (rel > hi[None, :])
+        old = filled.reindex(columns=pre.columns).reindex(window.index).to_numpy()
+        window = pd.DataFrame(np.where(outside, old, window.to_numpy()), index=window.index, columns=pre.columns)
+        return pd.concat([
+            filled[filled.index < index[a]].reindex(columns=pre.columns),
+            _fill_frame(window),
+            filled[filled.index > index[b]].reindex(columns=pre.columns),
+        ])
     
-    def fill_data(self, df, det_sensors): 
+    def append_raw_data(self, path):
+        """
+        Merges the documents of a new raw data file into the frames of the
+        previous extract_raw_data(), preprocess_data() and fill_data() calls
+        of an incremental Extract. Only the days with new samples are checked
+        again for their variance, and only the rows around them are
+        interpolated again. The merged frames live in this object only: they
+        are not written to the FrameCache, and the registry, the generators
+        and train.py do not call this method, so the next extraction starts
+        from the original data file again.
+        
+        Args:
+            path (str): file with the new documents, in the format of the reader.
+        
+        Returns:
+            tuple[dict, list]: A new dictionary of the filled sensors
+                               and deterministic sensors.
+        """
+        if not self.incremental:
+            raise RuntimeError('append_raw_data() needs an Extract created with incremental=True')
+        if not all(hasattr(self, attr) for attr in ('_extracted', '_pre_data', '_filled')):
+            raise RuntimeError('append_raw_data() needs a previous extract_raw_data(), preprocess_data() and fill_data() run')
+        
+        new_obj = type(self)(self.sensors, self.category, self.machinery, heads=self.heads, reader=self.reader, types=self.types, tail=self.tail, verbose=False)
+        new_obj.category_path = path
+        new_data = new_obj._extract_raw_data()
+        
+        det_sensors = set(self._det_sensors)
+        for sensor in self.sensors:
+            new = new_data[sensor]
+            if new.empty:
+                continue
+            merged = pd.concat([self._extracted[sensor], new]).sort_index(kind='stable')
+            merged = merged[~merged.reset_index().duplicated().to_numpy()]
+            self._extracted[sensor] = merged
+            
+            days = merged.index.normalize()
+            affected = new.index.normalize().unique()
+            kept = set() if sensor in det_sensors else set(self._pre_data[sensor].index.normalize().unique())
+            kept -= set(affected)
+            affected_days, _, day_var = _daily_variance({sensor: merged[days.isin(affected)]})[sensor]
+            kept.update(affected_days[day_var > 1e-1])
+            
+            was_det = sensor in det_sensors
+            if kept:
+                det_sensors.discard(sensor)
+                self._pre_data[sensor] = merged[days.isin(list(kept))]
+            else:
+                if self.verbose:
+                    print(f'Sensor {sensor} is deterministic.')
+                det_sensors.add(sensor)
+                self._pre_data[sensor] = merged
+            
+            if self.tail is not None:
+                self._filled[sensor] = _fill_tail(self._pre_data[sensor], self.tail)
+            elif was_det != (sensor in det_sensors):
+                self._filled[sensor] = _fill_frame(self._pre_data[sensor])
+            else:
+                start, end = affected.min(), affected.max() + pd.Timedelta(days=1)
+                self._filled[sensor] = self._fill_seam(self._pre_data[sensor], self._filled[sensor], start, end)
+            if self.types is not None:
+                self._filled[sensor] = _compact_frame(self._filled[sensor], self.types.get(sensor))
+        
+        self._det_sensors = [sensor for sensor in self.sensors if sensor in det_sensors]
+        return dict(self._filled), list(self._det_sensors)
+        
+    
+    def fill_data(self, df, det_sensors, inplace=False): 
         """
         Args:
             extr_df (dict): a dictionary containing all heads as values and sensors and keys.
+            inplace (bool): whether to replace the frames of the given dictionary
+                            instead of returning a new one. The previous frames
+                            can then be freed while the next sensor is filled,
+                            unless the Extract is incremental.
         
         Returns:
             tuple[dict, list]: A new dictionary of the preprocessed sensors
                                and deterministic sensors.
         """
-        filled = copy.deepcopy(df)
+        # The frames are never modified, so the entries that are not filled are shared
+        filled = df if inplace else dict(df)
         for sensor in self.sensors:
-            filled[sensor] = df[sensor].interpolate(method='linear').dropna(axis=0)
-            filled[sensor] = filled[sensor].query('~index.duplicated()')
+            if self.tail is not None:
+                filled[sensor] = _fill_tail(df[sensor], self.tail)
+            else:
+                filled[sensor] = _fill_frame(df[sensor])
+            if self.types is not None:
+                filled[sensor] = _compact_frame(filled[sensor], self.types.get(sensor))
             
         if self.verbose:
             print('NaN values have been filled.')
+        if self.incremental:
+            self._filled = dict(filled)
         return filled
     
         
@@ -194,7 +557,7 @@ class ExtractPlc:
             This is the first step to get the data based on heads and different sensors.
         preprocess_data(extr_df):
             Preprocesses the data to from original timestamps.
-        fill_data(df, det_sensors):
+        fill_data(df, det_sensors, inplace=False):
             Fill the NaN values in the DataFrame.
     """
     def __init__(
@@ -207,7 +570,11 @@ class ExtractPlc:
             figs_dir: str ='./figs',
             plt_style: str = 'Solarize_Light2',
             data_path: str = './data',
-            verbose: bool = True
+            verbose: bool = True,
+            reader: str = 'json',
+            cache_dir: str = None,
+            types: dict = None,
+            tail: int = None
             ):
         """
         Initialize a new instance of Extract.
@@ -215,21 +582,31 @@ class ExtractPlc:
         Args:
             sensors (list): list of all sensors we want to analyze
             category (str): name of category ['eqtq', 'drive']
-            machinery (str): name of machinery
+            machinery (str): name of machinery, documents of other machineries are skipped
             show_fig (bool): whether to show the figs while extracting
             save_fig (bool): whether to save the figs while extracting
             figs_dir (str): figs directory.
             plt_style (str): plot styles.
             data_path (str): original data path of the sensors.
             verbose (bool): whether to print any information regarding extraction.
+            reader (str): format of the raw data files ['json', 'bson'].
+            cache_dir (str): directory of the extracted frames cache, None to disable it.
+            types (dict): types of the sensors (type_sensors.pickle of the category),
+                          the filled frames are downcast when given.
+            tail (int): number of trailing rows filled for each sensor, None to fill
+                        the whole history.
         """
         self.verbose=verbose
         self.figs_dir = figs_dir
         self.sensors = sensors.copy()
         self.machinery = machinery
         self.category = category
-        self.category_path = os.path.join(data_path, 'MongoData' + category.upper() +'.json')
+        self.reader = reader
+        self.category_path = _category_path(data_path, category, reader)
         self.raw_data = None
+        self.cache = FrameCache(cache_dir) if cache_dir else None
+        self.types = types
+        self.tail = tail
         self.verbose = verbose
         # we define some addiftional sensor to be identified as deterministc sesnsors
         self.additional_det = ['Alarm', 'OperationState', 'TotalProduct']
@@ -237,16 +614,19 @@ class ExtractPlc:
         if show_fig: self._set_plt_style(plt_style)
         
     def _set_plt_style(self, plt_style):
+        import matplotlib.pyplot as plt
         plt.style.use(plt_style)
         
     
     def _set_sensors_dict(self):
         self.sensor_dict = {key: pd.DataFrame(columns=['value']) for key in self.sensors}
         
+    def _keep_document(self, doc):
+        # The original exports have no machinery_uid, their documents are always kept
+        return doc.get('machinery_uid', self.machinery) == self.machinery
+        
     def _set_data(self):
-        with open(self.category_path, 'r') as datafile:
-            data = json.load(datafile)
-        self.raw_data = pd.DataFrame(data)
+        self.raw_data = pd.DataFrame(_read_documents(self.category_path, self.reader, self._keep_document))
         if self.verbose:
             print(f'\n1 head and {len(self.sensors)} sensors detected in "{self.category}" sensor category.')
 
@@ -270,7 +650,22 @@ class ExtractPlc:
         Returns:
             dict: a dictionary containing all heads as values and sensors and keys
         """
+        if self.cache is not None:
+            key = self.cache.key(self.category_path, extractor=type(self).__name__, machinery=self.machinery)
+            cached = self.cache.load(key, self.sensors)
+            if cached is not None:
+                if self.verbose:
+                    print(f'Loaded {len(self.sensors)} sensors of "{self.category}" from cache.')
+                self.sensor_dict = cached
+                return self.sensor_dict
+        
+        self.get_raw_data()
+        self._extract_raw_data()
+        if self.cache is not None:
+            self.cache.save(key, self.sensor_dict)
+        return self.sensor_dict
         
+    def _extract_raw_data(self):
         self._set_sensors_dict()
         sensors_cpy = self.sensors.copy()
         if self.verbose:
@@ -283,8 +678,8 @@ class ExtractPlc:
             # In this function we try to understand the relationship between deifferent heads
             # We delete the index, so we can join different heads, this is a prototype. 
             df_by_sensor = self.raw_data[self.raw_data.variable.str.contains(sensor)]
-            df_all = pd.DataFrame(df_by_sensor.samples.sum())
-            df_all.time = df_all.time.map(lambda x: int(x[list(x.keys())[0]]))
+            df_all = pd.DataFrame(list(itertools.chain.from_iterable(df_by_sensor.samples)))
+            df_all.time = _unwrap_time(df_all.time)
             df_all.index = df_all.set_index('time').index.astype(int)/1000
             df_all = df_all.drop_duplicates()
             self.sensor_dict[sensor] = df_all
@@ -309,46 +704,46 @@ class ExtractPlc:
         """
         deterministic_sensor = []
         new_df = extr_df
+        # The variance of each day is computed for all the sensors at once
+        variance = _daily_variance({sensor: new_df[sensor][['value']] for sensor in self.sensors})
         for sensor in self.sensors:
-            # We group the data for each sensor based on the days
-            results = [group[1] for group in new_df[sensor].groupby(new_df[sensor].index.date)]
-            # result[2].interpolate(method='linear').plot(legend=False)
-            tot_var = 0
-            new_results = []
-            for result in results:
-                # We remove results that do not have sufficent variance in their heads. We catogorize them as deterministic sensors
-                if len(result)<=1:
-                    continue
-                tot_var += result.value.var().sum()
-                if result.value.var().sum() > 1e-1: new_results.append(result)
-
-            if len(new_results)==0:
-                
+            _, codes, day_var = variance[sensor]
+            # We remove days that do not have sufficent variance. We catogorize them as deterministic sensors
+            keep = day_var > 1e-1
+            if not keep.any():
                 if self.verbose:
-                    print(f'Sensor {sensor} has total variance of {tot_var} and is deterministic.')
+                    print(f'Sensor {sensor} has total variance of {day_var.sum()} and is deterministic.')
                 deterministic_sensor.append(sensor)
                 continue
             deterministic_sensor.extend(self.additional_det)
             
-            new_df[sensor] = pd.concat(new_results)
+            new_df[sensor] = _select_days(new_df[sensor], codes, keep)
         return new_df, deterministic_sensor
     
 
         
     
-    def fill_data(self, df, det_sensors): 
+    def fill_data(self, df, det_sensors, inplace=False): 
         """
         Args:
             extr_df (dict): a dictionary containing all heads as values and sensors and keys.
+            inplace (bool): whether to replace the frames of the given dictionary
+                            instead of returning a new one. The previous frames
+                            can then be freed while the next sensor is filled.
         
         Returns:
             tuple[dict, list]: A new dictionary of the preprocessed sensors
                                and deterministic sensors.
         """
-        filled = copy.deepcopy(df)
+        # The frames are never modified, so the entries that are not filled are shared
+        filled = df if inplace else dict(df)
         for sensor in self.sensors:
-            filled[sensor] = df[sensor].interpolate(method='linear').dropna(axis=0)
-            filled[sensor] = filled[sensor].query('~index.duplicated()')
+            if self.tail is not None:
+                filled[sensor] = _fill_tail(df[sensor], self.tail)
+            else:
+                filled[sensor] = _fill_frame(df[sensor])
+            if self.types is not None:
+                filled[sensor] = _compact_frame(filled[sensor], self.types.get(sensor))
         
         if self.verbose:
             print('NaN values have been filled.')
@@ -357,6 +752,75 @@ class ExtractPlc:
 
 
 
+def _heads_figure(df, title, colors, path, show_fig, time_axis=True):
+    # plotly is only imported when plotting, not by every process using Extract
+    import plotly.io as pio
+    import plotly.express as px
+    
+    fig = px.line(df, x=df.index, y=df.columns, title=title, color_discrete_sequence=colors)
+    if time_axis:
+        fig.update_xaxes(
+            tickangle = 90,
+            tickformat="%H:%M:%S", # the date format you want 
+        )
+    else:
+        fig.update_xaxes(visible=False)
+    pio.write_image(fig, path, width=1320, height=720)
+    if show_fig:
+        fig.show()
+
+
+def _correlation_figure(df, title, path, show_fig):
+    import matplotlib.pyplot as plt
+    
+    f = plt.figure(figsize=(19, 15))
+    plt.matshow(df.corr(), fignum=f.number)
+    plt.xticks(range(df.select_dtypes(['number']).shape[1]), df.select_dtypes(['number']).columns, fontsize=8, rotation=45)
+    plt.yticks(range(df.select_dtypes(['number']).shape[1]), df.select_dtypes(['number']).columns, fontsize=8)
+    cb = plt.colorbar()
+    cb.ax.tick_params(labelsize=10)
+    plt.title(title, fontsize=12)
+    plt.savefig(path, bbox_inches='tight')
+    
+    if show_fig:
+        plt.show()
+    plt.close(f)
+
+
+def _heads_jobs(df, sensor, category, colors, save_folder='./figs/data'):
+    save_dir = save_folder + '/' + category
+    jobs = []
+    for result in [group[1] for group in df.groupby(df.index.date)]:
+        title = f'{category} Sensor Category - {sensor.capitalize()} Sensor - Day {result.index[0].day}'
+        jobs.append(('heads', result, title, colors, f"{save_dir}/{sensor}_heads_{result.index[0].day}.png", True))
+    title = f'{category} Sensor Category - {sensor.capitalize()} Sensor'
+    jobs.append(('heads', df.reset_index(drop=True), title, colors, f"{save_dir}/{sensor}_heads.png", False))
+    return jobs
+
+
+def _correlation_jobs(df, sensor, category, save_folder='./figs/correlation'):
+    title = f'{category} Heads Correlation Matrix - {sensor.capitalize()} Sensor'
+    return [('correlation', df.reset_index(drop=True), title, None, f"{save_folder}/{category}/{sensor}_corr.png", None)]
+
+
+def _figure_hash(job):
+    kind, df, title, colors, _, time_axis = job
+    sha = hashlib.sha1(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    sha.update(json.dumps([kind, title, colors, time_axis, [str(col) for col in df.columns]]).encode())
+    return sha.hexdigest()
+
+
+def _render_figure(job):
+    kind, df, title, colors, path, time_axis = job
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if kind == 'heads':
+        _heads_figure(df, title, colors, path, False, time_axis)
+    else:
+        _correlation_figure(df, title, path, False)
+    return path, time.perf_counter() - start
+
+
 def plot_heads(df, sensor, category, colors, show_fig, save_folder='./figs/data') -> None:
     """
     Plot all heads sensor data based on the sensor in each category. All the 
@@ -373,31 +837,9 @@ def plot_heads(df, sensor, category, colors, show_fig, save_folder='./figs/data'
     Returns:
         None
     """
-    save_dir = save_folder + '/' + category
-    os.makedirs(save_dir, exist_ok=True)
-    results = [group[1] for group in df.groupby(df.index.date)]
-    for result in results:
-        fig = go.Figure()
-        fig = px.line(result, x=result.index, y=result.columns, title=f'{category} Sensor Category - {sensor.capitalize()} Sensor - Day {result.index[0].day}', color_discrete_sequence=colors)
-        fig.update_xaxes(
-            tickangle = 90,
-            tickformat="%H:%M:%S", # the date format you want 
-        )
-        
-        pio.write_image(fig, f"{save_dir}/{sensor}_heads_{result.index[0].day}.png", width=1320, height=720)
-        if show_fig:
-            fig.show()
-        
-    
-    df = df.reset_index(drop=True)
-    fig = go.Figure()
-    fig = px.line(df, x=df.index, y=df.columns, title=f'{category} Sensor Category - {sensor.capitalize()} Sensor', color_discrete_sequence=colors)
-    fig.update_xaxes(visible=False)
-    pio.write_image(fig, f"{save_dir}/{sensor}_heads.png", width=1320, height=720)
-    if show_fig:
-        fig.show()
-        
-
+    os.makedirs(save_folder + '/' + category, exist_ok=True)
+    for _, result, title, colors, path, time_axis in _heads_jobs(df, sensor, category, colors, save_folder):
+        _heads_figure(result, title, colors, path, show_fig, time_axis)
         
             
             
@@ -416,19 +858,61 @@ def plot_correlation(df, sensor, category, show_fig, save_folder='./figs/correla
     Returns:
         None
     """
-    
-    df = df.reset_index(drop=True)
-    save_dir = save_folder + '/' + category
-    os.makedirs(save_dir, exist_ok=True)
+    os.makedirs(save_folder + '/' + category, exist_ok=True)
+    for _, result, title, _, path, _ in _correlation_jobs(df, sensor, category, save_folder):
+        _correlation_figure(result, title, path, show_fig)
 
-    f = plt.figure(figsize=(19, 15))
-    plt.matshow(df.corr(), fignum=f.number)
-    plt.xticks(range(df.select_dtypes(['number']).shape[1]), df.select_dtypes(['number']).columns, fontsize=8, rotation=45)
-    plt.yticks(range(df.select_dtypes(['number']).shape[1]), df.select_dtypes(['number']).columns, fontsize=8)
-    cb = plt.colorbar()
-    cb.ax.tick_params(labelsize=10)
-    plt.title(f'{category} Heads Correlation Matrix - {sensor.capitalize()} Sensor', fontsize=12)
-    plt.savefig(f"{save_dir}/{sensor}_corr.png",bbox_inches='tight')
+
+def plot_batch(figures, workers=None, manifest='./figs/manifest.json', verbose=True) -> dict:
+    """
+    Renders many figures of plot_heads() and plot_correlation() at once. Every
+    figure (one per day and sensor for the heads) is a separate job of a
+    process pool, and figures whose data and title did not change since the
+    last run are skipped.
+
+    Args:
+        figures (list): tuples ('heads', df, sensor, category, colors) or
+                        ('correlation', df, sensor, category).
+        workers (int): number of processes, None for the number of cpus.
+        manifest (str): json file with the content hash of the rendered figures.
+        verbose (bool): whether to print the rendering time of each figure.
+
+    Returns:
+        dict: rendering time in seconds of each figure path, None if skipped.
+    """
+    jobs = []
+    for figure in figures:
+        if figure[0] == 'heads':
+            jobs.extend(_heads_jobs(*figure[1:]))
+        elif figure[0] == 'correlation':
+            jobs.extend(_correlation_jobs(*figure[1:]))
+        else:
+            raise ValueError(f'Unknown figure type: {figure[0]}')
     
-    if show_fig:
-        plt.show()
+    hashes = {}
+    if os.path.exists(manifest):
+        with open(manifest, 'r') as handle:
+            hashes = json.load(handle)
+    
+    timings, pending = {}, []
+    for job in jobs:
+        digest = _figure_hash(job)
+        if hashes.get(job[4]) == digest and os.path.exists(job[4]):
+            timings[job[4]] = None
+        else:
+            hashes[job[4]] = digest
+            pending.append(job)
+    
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for path, elapsed in executor.map(_render_figure, pending):
+            timings[path] = elapsed
+            if verbose:
+                print(f'{path}: {elapsed:.2f}s')
+    
+    os.makedirs(os.path.dirname(manifest) or '.', exist_ok=True)
+    with open(manifest, 'w') as handle:
+        json.dump(hashes, handle, indent=1)
+    if verbose:
+        print(f'{len(pending)} figures rendered in {time.perf_counter() - start:.2f}s, {len(jobs) - len(pending)} unchanged figures skipped.')
+    return timings
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import weakref
+import threading
+import torch
+from collections import OrderedDict
+from modules.cache import file_digest
+from modules.trainer import Trainer, ExportedModel, exported_path
+
+
+class ExtractionRegistry:
+    """
+    This class have been designed to share the filled sensor frames between
+    all the generators of a process. The get_raw_data(), extract_raw_data(),
+    preprocess_data() and fill_data() chain runs once for each extractor,
+    category and machinery, and every generator receives the same frames.
+    The frames are shared, so they must be treated as read-only. When the
+    data file changes, the new extraction replaces the old one.
+
+
+    Methods:
+        get(extractor, sensors, category, machinery, **kwargs):
+            Returns the filled frames and the deterministic sensors.
+        clear():
+            Drops all the stored extractions.
+    """
+    def __init__(self):
+        """
+        Initialize a new instance of ExtractionRegistry.
+        """
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _key(self, extract_obj, kwargs):
+        # The digest of the source file invalidates the entry when the data changes
+        options = json.dumps(kwargs, sort_keys=True, default=str)
+        return (type(extract_obj).__name__, extract_obj.category, extract_obj.machinery,
+                tuple(extract_obj.sensors), options, file_digest(extract_obj.category_path))
+
+    def get(self, extractor, sensors, category, machinery, **kwargs):
+        """
+        Args:
+            extractor (type): Extract or ExtractPlc.
+            sensors (list): list of all sensors we want to analyze.
+            category (str): name of category ['eqtq', 'drive', 'plc'].
+            machinery (str): name of machinery.
+            kwargs: other arguments of the extractor.
+
+        Returns:
+            tuple[dict, list]: filled frames of the sensors and deterministic sensors.
+        """
+        extract_obj = extractor(sensors, category, machinery, **kwargs)
+        key = self._key(extract_obj, kwargs)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        # Different categories are extracted concurrently, the same one only once
+        with lock:
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is None:
+                extracted_data = extract_obj.extract_raw_data()
+                _, det_sensors = extract_obj.preprocess_data(extracted_data)
+                entry = (extract_obj.fill_data(extracted_data, det_sensors, inplace=True), det_sensors)
+                with self._lock:
+                    # A new digest replaces the extraction of the old data file
+                    for old in [old for old in self._entries if old[:-1] == key[:-1]]:
+                        del self._entries[old]
+                        self._locks.pop(old, None)
+                    self._entries[key] = entry
+        filled_df, det_sensors = entry
+        return dict(filled_df), list(det_sensors)
+
+    def clear(self) -> None:
+        """
+        Drops all the stored extractions.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._locks.clear()
+
+
+class ModelRegistry:
+    """
+    This class have been designed to share the TFT checkpoints between all
+    the generators of a process. A checkpoint is loaded once for each path,
+    modification time, device, backend and quantization, set in eval mode
+    without gradients, and the same Trainer is returned to every generator,
+    so the models must be treated as read-only. The loaded models are
+    tracked with weak references, so a model still held by a generator is
+    returned again instead of being loaded twice. When the models alive in
+    the process exceed the memory budget, the least recently used cached
+    models that nothing else references are dropped; the models held by the
+    generators are never counted twice but can exceed the budget.
+
+
+    Methods:
+        get(path, device, backend, quantize, tolerance):
+            Returns the Trainer (or the ExportedModel) of a checkpoint,
+            loading it if needed.
+        touch(trainer):
+            Marks a model as recently used.
+        nbytes():
+            Memory of the parameters and buffers of the loaded models.
+        clear():
+            Drops all the cached models.
+    """
+    def __init__(
+            self,
+            max_bytes: int = None
+            ):
+        """
+        Initialize a new instance of ModelRegistry.
+
+        Args:
+            max_bytes (int): memory budget of the loaded models, None for no limit.
+        """
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._live = weakref.WeakValueDictionary()
+        self._keys = weakref.WeakKeyDictionary()
+        self._sizes = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(model) -> int:
+        tensors = list(model.parameters()) + list(model.buffers())
+        # The weights of the int8 layers are packed, outside the parameters
+        for module in model.modules():
+            if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+                tensors += [tensor for tensor in module._weight_bias() if tensor is not None]
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+    def _cached(self, key):
+        # Cached models and models still held by the generators, None when not loaded
+        trainer = self._live.get(key)
+        if trainer is not None:
+            self._entries[key] = trainer
+            self._entries.move_to_end(key)
+        return trainer
+
+    def get(self, path, device='cpu', backend='checkpoint', quantize=False, tolerance=0.02) -> Trainer:
+        """
+        Args:
+            path (str): path of the checkpoint.
+            device (str): device of the model.
+            backend (str): 'checkpoint' to load the Lightning checkpoint, or
+                'torchscript' to run the artifact written next to it by
+                Trainer.export() on CPU. The checkpoint is used when the
+                artifact does not exist or is older than the checkpoint.
+            quantize (bool): whether to load the int8 version of the
+                checkpoint, see Trainer.load_model(). It uses less memory
+                but runs slower than the float model.
+            tolerance (float): maximum relative error of the int8 model.
+
+        Returns:
+            Trainer: trainer with the loaded model (or ExportedModel), shared
+            with the other callers.
+        """
+        artifact = exported_path(path)
+        if backend == 'torchscript' and os.path.exists(artifact) and os.path.getmtime(artifact) >= os.path.getmtime(path):
+            path, device = artifact, 'cpu'
+        else:
+            if backend == 'torchscript' and os.path.exists(artifact):
+                print(f"{artifact} is older than its checkpoint, the checkpoint is used")
+            backend = 'checkpoint'
+        path = os.path.abspath(path)
+        quantize = quantize and backend == 'checkpoint'
+        key = (path, os.stat(path).st_mtime_ns, device, backend, quantize, tolerance)
+        with self._lock:
+            trainer = self._cached(key)
+            if trainer is not None:
+                # The models released by the generators since the last call can be dropped now
+                self._evict(key)
+                return trainer
+            lock = self._locks.setdefault(key, threading.Lock())
+        # Different checkpoints are loaded concurrently, the same one only once
+        with lock:
+            with self._lock:
+                trainer = self._cached(key)
+                if trainer is not None:
+                    return trainer
+            try:
+                if backend == 'torchscript':
+                    trainer = ExportedModel(path)
+                else:
+                    trainer = Trainer(device=device)
+                    trainer.load_model(path, quantize, tolerance)
+                    trainer.model.eval()
+                    trainer.model.requires_grad_(False)
+                with self._lock:
+                    # A new modification time replaces the old model of the same file and options
+                    for old in [old for old in self._entries if old[0] == path and old[2:] == key[2:]]:
+                        del self._entries[old]
+                        self._locks.pop(old, None)
+                    self._entries[key] = trainer
+                    self._live[key] = trainer
+                    self._keys[trainer] = key
+                    # The weights of the exported models are frozen in the graph, their size is saved with the artifact
+                    self._sizes[key] = trainer.nbytes if backend == 'torchscript' else self._size(trainer.model)
+                    self._evict(key)
+            finally:
+                # The lock is only needed while loading, also when the load fails
+                with self._lock:
+                    if self._locks.get(key) is lock:
+                        del self._locks[key]
+        return trainer
+
+    def touch(self, trainer) -> None:
+        """
+        Args:
+            trainer (Trainer): model returned by get(), used for a prediction.
+        """
+        with self._lock:
+            key = self._keys.get(trainer)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+    def _nbytes(self):
+        # Sizes of the models that are no longer alive are forgotten
+        for key in [key for key in self._sizes if key not in self._live]:
+            del self._sizes[key]
+        return sum(self._sizes.values())
+
+    def _evict(self, newest):
+        # Dropping a model that a generator still holds would not free any memory
+        for key in list(self._entries):
+            if self.max_bytes is None or self._nbytes() <= self.max_bytes:
+                break
+            # The references of the entry and of the getrefcount() argument only
+            if key != newest and sys.getrefcount(self._entries[key]) <= 2:
+                del self._entries[key]
+                self._locks.pop(key, None)
+
+    def nbytes(self) -> int:
+        """
+        Returns:
+            int: memory of the parameters and buffers of the models alive in
+            the process, cached or held by the generators.
+        """
+        with self._lock:
+            return self._nbytes()
+
+    def clear(self) -> None:
+        """
+        Drops all the cached models.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._locks.clear()
+
+
+registry = ExtractionRegistry()
+models = ModelRegistry(max_bytes=int(os.environ.get('MODEL_CACHE_MB', 1024)) * 2**20)
@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
 import os
+import copy
+import json
+import pickle
+import warnings
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import lightning.pytorch as pl
@@ -10,6 +15,7 @@ from dataclasses import field
 from lightning.pytorch.callbacks import EarlyStopping, LearningRateMonitor, ModelCheckpoint
 from lightning.pytorch.loggers import TensorBoardLogger
 from lightning.pytorch.tuner import Tuner
+from lightning.fabric.utilities.data import AttributeDict
 
 from pytorch_forecasting import TemporalFusionTransformer, TimeSeriesDataSet
 from pytorch_forecasting.data import GroupNormalizer
@@ -18,6 +24,267 @@ from pytorch_forecasting.data.encoders import EncoderNormalizer, MultiNormalizer
 import torch
 
 
+def _to_device(x, device):
+    # The collated batch is a dictionary of tensors and tuples of tensors
+    if isinstance(x, torch.Tensor):
+        return x.to(device)
+    if isinstance(x, dict):
+        return {name: _to_device(value, device) for name, value in x.items()}
+    if isinstance(x, (list, tuple)):
+        return type(x)(_to_device(value, device) for value in x)
+    return x
+
+
+def exported_path(path) -> str:
+    """Returns the path of the TorchScript artifact written next to a checkpoint by Trainer.export()."""
+    return os.path.splitext(path)[0] + '.pt'
+
+
+def quantization_path(path) -> str:
+    """Returns the path of the accuracy check of the int8 model written next to a checkpoint by Trainer.check_quantization()."""
+    return os.path.splitext(path)[0] + '.int8.json'
+
+
+def quantize_model(model):
+    """
+    Returns an int8 copy of a TFT model, with post-training dynamic
+    quantization of the linear layers (CPU only). The LSTM layers of
+    pytorch_forecasting take the sequence lengths and stay in float32.
+    It halves the memory of the weights but is slower than the float model
+    on the small models of this repo (hidden_size 8), so it is a memory
+    option, not a speed one: the int8 kernels cost more than the float ones
+    they replace, about 300 against 224 ms per tick (38 against 26 ms for 3
+    heads with bench.py quantize).
+
+    Args:
+        model (TemporalFusionTransformer): the model on CPU.
+
+    Returns:
+        TemporalFusionTransformer: the quantized copy.
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class _Network(torch.nn.Module):
+    # Traced wrapper that returns the quantile prediction only, the other outputs are not needed to generate
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x)['prediction']
+
+
+class WindowEncoder:
+    """
+    This class have been designed to encode the encoder windows of the
+    generators for a TFT model without building a TimeSeriesDataSet. It keeps
+    the fitted scalers of the training dataset, and the categorical codes and
+    the target normalization of each series (day, and head for the multi-head
+    models) are taken once from the library and then cached. Only the dataset layout used by Trainer.create_dataloaders()
+    is supported, see supports().
+
+
+    Methods:
+        supports(frames):
+            Whether the windows can be encoded without the library.
+        encode(frames):
+            Returns the batch of the windows, as collated by the dataloader.
+    """
+    def __init__(self, model):
+        """
+        Initialize a new instance of WindowEncoder.
+
+        Args:
+            model (TemporalFusionTransformer): the trained model.
+        """
+        self.parameters = model.dataset_parameters
+        self.reals = list(model.hparams.x_reals)
+        self.target = self.parameters['target']
+        self.time_idx = self.parameters['time_idx']
+        self.groups = list(self.parameters['group_ids'])
+        self._series = {}
+
+        known = {'encoder_length', 'relative_time_idx', self.time_idx, self.target,
+                 f'{self.target}_center', f'{self.target}_scale'}
+        self.layout = (
+            isinstance(self.target, str)
+            and isinstance(self.parameters['target_normalizer'], GroupNormalizer)
+            and list(model.hparams.x_categoricals) == self.groups
+            and not self.parameters['lags']
+            and set(self.reals) <= known
+        )
+        if self.layout:
+            scaler = self.parameters['scalers'][self.time_idx]
+            self._time_mean, self._time_scale = float(scaler.mean_[0]), float(scaler.scale_[0])
+
+    def _values(self, frame):
+        if self.target in frame.columns:
+            return frame[self.target]
+        return frame[[col for col in frame.columns if col != self.time_idx and col not in self.groups][0]]
+
+    def _encoding(self, frame):
+        # Categorical codes, target scale and encoded center and scale of a series
+        series = tuple(str(frame[name].iloc[-1]) for name in self.groups)
+        if series not in self._series:
+            frame = frame[[self.time_idx, *self.groups]].assign(**{self.target: self._values(frame)})
+            dataset = TimeSeriesDataSet.from_parameters(self.parameters, frame, predict=True)
+            x, _ = dataset[len(dataset) - 1]
+            normalizer = dataset.target_normalizer
+            codes = x['x_cat'][0].numpy()
+            norm = normalizer.get_norm(pd.DataFrame({name: codes[i:i + 1] for i, name in enumerate(self.groups)}))[0]
+            self._series[series] = (codes, x['groups'], torch.as_tensor(x['target_scale'], dtype=torch.float),
+                                    {name: float(x['x_cont'][0, self.reals.index(name)])
+                                     for name in [f'{self.target}_center', f'{self.target}_scale'] if name in self.reals},
+                                    norm, normalizer)
+        return self._series[series]
+
+    def supports(self, frames) -> bool:
+        """
+        Args:
+            frames (list): dataframes with time_idx, value and day columns.
+
+        Returns:
+            bool: True when every window is a single series, with consecutive
+            time indexes and enough samples for the encoder and the decoder.
+        """
+        if not self.layout or not frames:
+            return False
+        lengths = set()
+        for frame in frames:
+            time_idx = frame[self.time_idx].to_numpy()
+            if any(frame[name].nunique() != 1 for name in self.groups) or np.any(np.diff(time_idx) != 1):
+                return False
+            lengths.add(len(frame))
+        length = lengths.pop()
+        encoder_length = min(length - self.parameters['max_prediction_length'], self.parameters['max_encoder_length'])
+        return not lengths and encoder_length >= self.parameters['min_encoder_length']
+
+    def encode(self, frames) -> dict:
+        """
+        Args:
+            frames (list): dataframes accepted by supports(), the value column
+                can have any name.
+
+        Returns:
+            dict: input of the model, equal to the dataloader batch.
+        """
+        decoder_length = self.parameters['max_prediction_length']
+        encoder_length = min(len(frames[0]) - decoder_length, self.parameters['max_encoder_length'])
+        length = encoder_length + decoder_length
+        size = len(frames)
+        cont = np.empty((size, length, len(self.reals)), dtype=np.float64)
+        cat = np.empty((size, length, len(self.groups)), dtype=np.int64)
+        target = np.empty((size, length), dtype=np.float64)
+        time_start = np.empty(size, dtype=np.int64)
+        groups, target_scale = [], []
+
+        columns = {name: self.reals.index(name) for name in self.reals}
+        for i, frame in enumerate(frames):
+            codes, group, scale, scales, norm, normalizer = self._encoding(frame)
+            values = self._values(frame).to_numpy(np.float64)[-length:]
+            time_idx = frame[self.time_idx].to_numpy()[-length:]
+            target[i] = values
+            cat[i] = codes
+            time_start[i] = time_idx[0]
+            groups.append(group)
+            target_scale.append(scale)
+            if self.time_idx in columns:
+                cont[i, :, columns[self.time_idx]] = (time_idx.astype(np.float64) - self._time_mean) / self._time_scale
+            if self.target in columns:
+                cont[i, :, columns[self.target]] = (normalizer.preprocess(values) - norm[0]) / norm[1]
+            for name, value in scales.items():
+                cont[i, :, columns[name]] = value
+
+        cont = torch.tensor(cont, dtype=torch.float)
+        if 'relative_time_idx' in columns:
+            cont[:, :, columns['relative_time_idx']] = (
+                torch.arange(-encoder_length, decoder_length, dtype=cont.dtype) / self.parameters['max_encoder_length']
+            )
+        if 'encoder_length' in columns:
+            cont[:, :, columns['encoder_length']] = (
+                (encoder_length - 0.5 * self.parameters['max_encoder_length']) / self.parameters['max_encoder_length'] * 2.0
+            )
+        cat = torch.from_numpy(cat)
+        target = torch.tensor(target, dtype=torch.float)
+        encoder_lengths = torch.full((size,), encoder_length, dtype=torch.long)
+        return dict(
+            encoder_cat=cat[:, :encoder_length],
+            encoder_cont=cont[:, :encoder_length],
+            encoder_target=target[:, :encoder_length],
+            encoder_lengths=encoder_lengths,
+            decoder_cat=cat[:, encoder_length:],
+            decoder_cont=cont[:, encoder_length:],
+            decoder_target=target[:, encoder_length:],
+            decoder_lengths=torch.full((size,), decoder_length, dtype=torch.long),
+            decoder_time_idx=(torch.from_numpy(time_start) + encoder_length).unsqueeze(1) + torch.arange(decoder_length).unsqueeze(0),
+            groups=torch.stack(groups),
+            target_scale=torch.stack(target_scale),
+        )
+
+
+class ExportedModel:
+    """
+    This class have been designed to run the TorchScript artifacts written by
+    Trainer.export() on CPU, without loading the Lightning checkpoint. The
+    artifact holds the traced network and the dataset parameters of the
+    training (scalers, categorical encoders and target normalizer), so the
+    windows are encoded with WindowEncoder as in Trainer.forecast(). The graph
+    is traced for one window length, the other windows go through the
+    checkpoint, which is loaded only then.
+
+
+    Methods:
+        forecast(frames):
+            Returns the quantile prediction of each window.
+    """
+    def __init__(self, path):
+        """
+        Initialize a new instance of ExportedModel.
+
+        Args:
+            path (str): path of the artifact, next to its checkpoint.
+        """
+        self.path = path
+        self.device = torch.device('cpu')
+        extra = {'dataset_parameters': '', 'hparams': ''}
+        self.model = torch.jit.load(path, map_location=self.device, _extra_files=extra)
+        self.model.eval()
+        self.dataset_parameters = pickle.loads(extra['dataset_parameters'])
+        hparams = json.loads(extra['hparams'])
+        self.hparams = AttributeDict(x_reals=hparams['x_reals'], x_categoricals=hparams['x_categoricals'])
+        self.window = hparams['window']
+        self.nbytes = hparams['nbytes']
+        self.encoder = WindowEncoder(self)
+        self._trainer = None
+
+    def _checkpoint(self):
+        if self._trainer is None:
+            self._trainer = Trainer(device='cpu')
+            self._trainer.load_model(os.path.splitext(self.path)[0] + '.ckpt')
+        return self._trainer
+
+    def forecast(
+            self,
+            frames: list
+            ):
+        """
+        Args:
+            frames (list): dataframes in the Extract() class format, with a
+                time_idx column, a day column (and a head column for the
+                multi-head models) and a single value column.
+
+        Returns:
+            list: quantile prediction tensor (samples x prediction length x
+            quantiles) of each frame, in the order of the frames.
+        """
+        if not self.encoder.supports(frames) or len(frames[0]) != self.window:
+            return self._checkpoint().forecast(frames)
+        # Without the profiling executor the first calls are not slowed down and no specialized graphs are kept in memory
+        with torch.inference_mode(), torch.jit.optimized_execution(False):
+            return list(self.model(self.encoder.encode(frames)).split(1))
+
+
 class Trainer:
     """
     This class have been designed to train, evaluate and validate the output
@@ -249,27 +516,62 @@ class Trainer:
 
 
 
-    def load_model(self, path):
+    def load_model(
+            self,
+            path: str,
+            quantize: bool = False,
+            tolerance: float = 0.02
+            ):
         """
         Loads the available TFT models. It is used in the Generation class
-        to generate new output.
+        to generate new output. With quantize, the model is replaced by its
+        int8 version (quantize_model()) when the accuracy check written by
+        check_quantization() is within the tolerance; otherwise the float
+        model is kept.
         
         Args:
             path (str): path to the trained model's checkpoint
+            quantize (bool): whether to quantize the model, on CPU only; it
+                saves memory but is slower than the float model, see
+                quantize_model()
+            tolerance (float): maximum relative error of the int8 model on
+                the validation set
             
         
         Returns:
             TemporalFusionTransformer: the built model
         """
+        self.path = path
         self.model = TemporalFusionTransformer.load_from_checkpoint(path, map_location=torch.device(self.device))
+        if not quantize:
+            return self.model
+        if self.device != 'cpu':
+            print(f"{path} is not quantized, the int8 kernels run on CPU only")
+        elif not os.path.exists(quantization_path(path)):
+            print(f"{path} is not quantized, its int8 model has not been checked")
+        else:
+            with open(quantization_path(path)) as handle:
+                error = json.load(handle)['error']
+            if error > tolerance:
+                print(f"{path} is not quantized, relative error {error:.4f} > {tolerance}")
+            else:
+                self.model = quantize_model(self.model.eval())
+        return self.model
 
 
 
     def fit(
         self,
+        export: bool = False,
         ):
         """
         Trains the model and saves best models based on the validation loss.
+
+        Args:
+            export (bool): whether to write the TorchScript artifact of the
+                best model next to its checkpoint, see export(). Only needed
+                by the 'torchscript' backend; existing checkpoints can be
+                exported later with export() or bench.py export
         """
         self.trainer.fit(
             self.tft,
@@ -277,10 +579,98 @@ class Trainer:
             val_dataloaders=self.val_dataloader,
         )
         best_model_path = self.trainer.checkpoint_callback.best_model_path
+        self.path = best_model_path
         self.model = TemporalFusionTransformer.load_from_checkpoint(best_model_path, map_location=torch.device(self.device))
+        if export:
+            self.export(best_model_path)
+
+
+
+    def export(
+            self,
+            path: str
+            ):
+        """
+        Traces the network of a checkpoint on CPU with TorchScript and saves
+        it next to the checkpoint (exported_path()), together with the dataset
+        parameters and the hyperparameters that ExportedModel needs to encode
+        the windows. The trace is made for the windows of the generators,
+        max_encoder_length samples, and any number of windows per batch. The
+        traced module is frozen, so the weights are constants of the graph.
+
+        Args:
+            path (str): path to the trained model's checkpoint
+
+        Returns:
+            str: path of the artifact, None when the layout of the dataset is
+            not supported by WindowEncoder
+        """
+        model = TemporalFusionTransformer.load_from_checkpoint(path, map_location=torch.device('cpu'))
+        model.eval()
+        encoder = WindowEncoder(model)
+        if not encoder.layout:
+            print(f"{path} can not be exported, the dataset layout is not supported")
+            return None
+
+        parameters = model.dataset_parameters
+        window = parameters['max_encoder_length']
+        frame = pd.DataFrame({parameters['time_idx']: np.arange(window), encoder.target: np.ones(window)})
+        for name in encoder.groups:
+            label = next(iter(parameters['categorical_encoders'][name].classes_))
+            frame[name] = pd.Categorical([label] * window)
+        example = encoder.encode([frame, frame])
+
+        # Lightning reads the attached trainer while the module is traced otherwise
+        model._jit_is_scripting = True
+        try:
+            with torch.no_grad(), warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                network = torch.jit.trace(_Network(model).eval(), (example,), strict=False, check_trace=False)
+        finally:
+            model._jit_is_scripting = False
+        # The weights become constants of the graph, which keeps the loaded artifact as small as the checkpoint model
+        network = torch.jit.freeze(network)
+
+        nbytes = sum(tensor.numel() * tensor.element_size() for tensor in [*model.parameters(), *model.buffers()])
+        hparams = dict(x_reals=list(model.hparams.x_reals), x_categoricals=list(model.hparams.x_categoricals),
+                       window=window, nbytes=nbytes)
+        torch.jit.save(network, exported_path(path), _extra_files={
+            'dataset_parameters': pickle.dumps(parameters),
+            'hparams': json.dumps(hparams),
+        })
+        return exported_path(path)
 
 
 
+    def check_quantization(
+            self
+            ):
+        """
+        Accuracy guard of the int8 models. The quantile outputs of the float
+        model and of its int8 version are compared on the validation
+        DataLoader, and the relative error (mean absolute difference over the
+        mean absolute float output) is saved next to the checkpoint
+        (quantization_path()), where load_model() reads it.
+        
+        
+        Returns:
+            float: relative error of the int8 model
+        """
+        model = copy.deepcopy(self.model).cpu().eval()
+        quantized = quantize_model(model)
+        difference, total = 0.0, 0.0
+        with torch.inference_mode():
+            for x, _ in self.val_dataloader:
+                expected = model(x)['prediction']
+                difference += float((quantized(x)['prediction'] - expected).abs().sum())
+                total += float(expected.abs().sum())
+        error = difference / total
+        with open(quantization_path(self.path), 'w') as handle:
+            json.dump({'error': error}, handle)
+        print(f"relative error of the int8 model: {error:.4f}")
+        return error
+
+
     def val_predict(
             self,
             plot: bool = True
@@ -374,4 +764,75 @@ class Trainer:
             self.model.plot_prediction(new_raw_predictions.x, new_raw_predictions.output, idx=0, show_future_observed=False)
             plt.show()
             
-        return new_raw_predictions
\ No newline at end of file
+        return new_raw_predictions
+
+
+
+    def predict_batch(
+            self,
+            frames: list
+            ):
+        """
+        Predicts many encoder windows with a single forward pass of the model,
+        without the dataloader and the Lightning trainer of predict(). Each
+        frame is encoded with the dataset parameters of the model, so the
+        windows of heads that share the same weights can be stacked in one
+        batch. The value column of a frame is renamed to the target of the
+        model when the names differ.
+
+        Args:
+            frames (list): dataframes in the Extract() class format, with a
+                time_idx column, a day column (and a head column for the
+                multi-head models) and a single value column.
+
+        Returns:
+            list: raw prediction tensor (samples x prediction length x quantiles)
+            of each frame, in the order of the frames.
+        """
+        parameters = self.model.dataset_parameters
+        target = parameters['target']
+        known = {parameters['time_idx'], *parameters['group_ids']}
+        samples, sizes = [], []
+        for frame in frames:
+            if target not in frame.columns:
+                value = [col for col in frame.columns if col not in known]
+                frame = frame.rename(columns={value[0]: target})
+            dataset = TimeSeriesDataSet.from_parameters(parameters, frame, predict=True)
+            samples.extend(dataset[i] for i in range(len(dataset)))
+            sizes.append(len(dataset))
+
+        x, _ = TimeSeriesDataSet._collate_fn(samples)
+        self.model.eval()
+        with torch.no_grad():
+            prediction = self.model(_to_device(x, self.model.device))['prediction']
+        return list(torch.split(prediction, sizes))
+
+
+    def forecast(
+            self,
+            frames: list
+            ):
+        """
+        Lightweight inference of the generators. The windows are encoded with
+        the cached scalers and encoders of the training dataset (WindowEncoder)
+        and the network is called directly under torch.inference_mode(). The
+        windows that WindowEncoder does not support go through predict_batch().
+
+        Args:
+            frames (list): dataframes in the Extract() class format, with a
+                time_idx column, a day column (and a head column for the
+                multi-head models) and a single value column.
+
+        Returns:
+            list: quantile prediction tensor (samples x prediction length x
+            quantiles) of each frame, in the order of the frames.
+        """
+        if getattr(self, '_encoder', None) is None or self._encoder.parameters is not self.model.dataset_parameters:
+            self._encoder = WindowEncoder(self.model)
+        if not self._encoder.supports(frames):
+            return self.predict_batch(frames)
+
+        x = _to_device(self._encoder.encode(frames), self.model.device)
+        self.model.eval()
+        with torch.inference_mode():
+            return list(self.model(x)['prediction'].split(1))
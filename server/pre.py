@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import pandas as pd
-from modules.preprocessing import Extract, ExtractPlc, plot_heads, plot_correlation
+from modules.preprocessing import Extract, ExtractPlc, plot_batch, plot_heads, plot_correlation
 from modules.config import PLC, DRIVE, EQTQ
 import os
+import argparse
 import plotly.express as px
 
 
@@ -28,55 +29,79 @@ from functools import partialmethod
 
 
 
-plc = PLC()
-drive = DRIVE()
-eqtq = EQTQ()
+def main(show_fig=False):
+    """
+    Extracts the data of the three categories and plots the heads and the
+    correlations of their non deterministic sensors. The figures are saved
+    at once by plot_batch() in a process pool; with show_fig they are drawn
+    one by one by plot_heads() and plot_correlation() and also shown.
+    """
+    plc = PLC()
+    drive = DRIVE()
+    eqtq = EQTQ()
 
 
-n_colors = 24
-colors = px.colors.sample_colorscale("greys", [n/(n_colors -1) for n in range(n_colors)]) 
-colors = px.colors.qualitative.Set2 
+    n_colors = 24
+    colors = px.colors.sample_colorscale("greys", [n/(n_colors -1) for n in range(n_colors)]) 
+    colors = px.colors.qualitative.Set2 
 
+    figures = []
 
-plc_data = ExtractPlc(category='plc', sensors=plc.all_sensors, machinery='JF890' ,show_fig=False, save_fig=True, verbose=False)
-raw_plc = plc_data.get_raw_data()
-extracted_raw_plc = plc_data.extract_raw_data()
-pre_plc, det_plc = plc_data.preprocess_data(extracted_raw_plc)
-fiiled_plc = plc_data.fill_data(pre_plc, det_plc)
-for sensor in plc.all_sensors:
-    if sensor not in det_plc:
-        sensor_plc =  sensor
-        plot_heads(fiiled_plc[sensor_plc], sensor_plc, 'plc', colors, True)
+    plc_data = ExtractPlc(category='plc', sensors=plc.all_sensors, machinery='JF890' ,show_fig=False, save_fig=True, verbose=False)
+    raw_plc = plc_data.get_raw_data()
+    extracted_raw_plc = plc_data.extract_raw_data()
+    pre_plc, det_plc = plc_data.preprocess_data(extracted_raw_plc)
+    fiiled_plc = plc_data.fill_data(pre_plc, det_plc)
+    for sensor in plc.all_sensors:
+        if sensor not in det_plc:
+            sensor_plc =  sensor
+            figures.append(('heads', fiiled_plc[sensor_plc], sensor_plc, 'plc', colors))
 
 
-drive_data = Extract(category='drive', sensors=drive.all_sensors, machinery='JF890' ,show_fig=False, save_fig=True, verbose=False)
-raw_drive = drive_data.get_raw_data()
-extracted_raw_drive = drive_data.extract_raw_data()
-pre_drive, det_drive = drive_data.preprocess_data(extracted_raw_drive)
-fiiled_drive = drive_data.fill_data(pre_drive, det_drive)
-for sensor in drive.all_sensors:
-    if sensor not in det_drive:
-        sensor_drive =  sensor
-        plot_correlation(fiiled_drive[sensor_drive], sensor_drive, 'drive', True)
-        plot_heads(fiiled_drive[sensor_drive], sensor_drive, 'drive', colors, True)
+    drive_data = Extract(category='drive', sensors=drive.all_sensors, machinery='JF890' ,show_fig=False, save_fig=True, verbose=False)
+    raw_drive = drive_data.get_raw_data()
+    extracted_raw_drive = drive_data.extract_raw_data()
+    pre_drive, det_drive = drive_data.preprocess_data(extracted_raw_drive)
+    fiiled_drive = drive_data.fill_data(pre_drive, det_drive)
+    for sensor in drive.all_sensors:
+        if sensor not in det_drive:
+            sensor_drive =  sensor
+            figures.append(('correlation', fiiled_drive[sensor_drive], sensor_drive, 'drive'))
+            figures.append(('heads', fiiled_drive[sensor_drive], sensor_drive, 'drive', colors))
 
 
 
-eqtq_data = Extract(category='eqtq', sensors=eqtq.all_sensors, machinery='JF890' ,show_fig=False, save_fig=True, verbose=False)
-raw_eqtq = eqtq_data.get_raw_data()
-extracted_raw_eqtq = eqtq_data.extract_raw_data()
-pre_eqtq, det_eqtq = eqtq_data.preprocess_data(extracted_raw_eqtq)
-fiiled_eqtq = eqtq_data.fill_data(pre_eqtq, det_eqtq)
-for sensor in eqtq.all_sensors:
-    if sensor not in det_eqtq:
-        sensor_eqtq =  sensor
-        plot_correlation(fiiled_eqtq[sensor_eqtq], sensor_eqtq, 'eqtq', True)
-        plot_heads(fiiled_eqtq[sensor_eqtq], sensor_eqtq, 'eqtq', colors, True)
+    eqtq_data = Extract(category='eqtq', sensors=eqtq.all_sensors, machinery='JF890' ,show_fig=False, save_fig=True, verbose=False)
+    raw_eqtq = eqtq_data.get_raw_data()
+    extracted_raw_eqtq = eqtq_data.extract_raw_data()
+    pre_eqtq, det_eqtq = eqtq_data.preprocess_data(extracted_raw_eqtq)
+    fiiled_eqtq = eqtq_data.fill_data(pre_eqtq, det_eqtq)
+    for sensor in eqtq.all_sensors:
+        if sensor not in det_eqtq:
+            sensor_eqtq =  sensor
+            figures.append(('correlation', fiiled_eqtq[sensor_eqtq], sensor_eqtq, 'eqtq'))
+            figures.append(('heads', fiiled_eqtq[sensor_eqtq], sensor_eqtq, 'eqtq', colors))
 
 
+    if show_fig:
+        for kind, *figure in figures:
+            if kind == 'heads':
+                plot_heads(*figure, True)
+            else:
+                plot_correlation(*figure, True)
+    else:
+        plot_batch(figures)
 
-sample_heads = ['Head_09', 'Head_10', 'Head_11', 'Head_12']
-print(fiiled_eqtq['AverageFriction'].head()[sample_heads].to_latex(float_format="{:.2f}".format))
+
+    sample_heads = ['Head_09', 'Head_10', 'Head_11', 'Head_12']
+    print(fiiled_eqtq['AverageFriction'].head()[sample_heads].to_latex(float_format="{:.2f}".format))
+
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='plots of the extracted sensor data')
+    parser.add_argument('--show', action='store_true', help='show every figure, rendered one by one instead of in a process pool')
+    main(parser.parse_args().show)
 
 
 
@@ -9,7 +9,7 @@ from bson.json_util import dumps
 from concurrent.futures import ThreadPoolExecutor
 from global_struct import Thread_struct
 from modules.utils import put_mongo, init_col, init_col_plc, put_mongo_plc
-from modules.generators import Generate, GeneratePlc
+from modules.generators import make_generator, predict_generators
 
 logging.basicConfig(format='%(message)s', level=logging.INFO)
 
@@ -60,7 +60,7 @@ def run_action_sensor(sensor_data):
     except Exception as e:
         print(f"An error occurred: {e}")
 
-def run_action_pool(machineries, mongo, dirpath='./generated_data'):
+def run_action_pool(machineries, mongo, dirpath='./generated_data', compact=False, lookahead=None, backend='checkpoint', quantize=False):
     if os.path.exists(dirpath) and os.path.isdir(dirpath):
         shutil.rmtree(dirpath)
     os.mkdir(dirpath)
@@ -79,12 +79,9 @@ def run_action_pool(machineries, mongo, dirpath='./generated_data'):
         for sensor in machinery["sensorsSelected"]:
             cats.append(sensor['category'])
             sensor_data = {"machinery_uid": machinery['uid'], "sensor": sensor}
-            if sensor['category']=='plc':
-                with open(os.devnull, "w") as f, contextlib.redirect_stdout(f):
-                    gen_object = GeneratePlc(sensor_data)
-            else:
-                with open(os.devnull, "w") as f, contextlib.redirect_stdout(f):
-                    gen_object = Generate(sensor_data)
+            # The deterministic sensors get the pandas-free GenerateDet()
+            with open(os.devnull, "w") as f, contextlib.redirect_stdout(f):
+                gen_object = make_generator(sensor_data, compact=compact, lookahead=lookahead, backend=backend, quantize=quantize)
             sensor['gen'] = gen_object
             
             if sensor['category']=='plc':
@@ -98,6 +95,7 @@ def run_action_pool(machineries, mongo, dirpath='./generated_data'):
         simulation_time += 1
         logging.info(f"{simulation_time}...")
 
+        tick = []
         for machinery in machineries:
             if simulation_time % machinery["faultFrequency"] == 0:
                 prob = random.randint(1, 100)
@@ -112,7 +110,15 @@ def run_action_pool(machineries, mongo, dirpath='./generated_data'):
                     sensor_data = {"machinery_uid": machinery['uid'], "sensor": sensor, "fault" : fault}
                     if machineryFault[machinery['uid']] == 1:
                         machineryFault[machinery['uid']] = 0
-                    Thread_struct.thread_pool_executor.submit(run_action_sensor, sensor_data)
+                    tick.append(sensor_data)
+
+        # The models of all the due sensors run once, before the samples are dispatched
+        try:
+            predict_generators([sensor_data['sensor']['gen'] for sensor_data in tick if not sensor_data['fault']])
+        except Exception as e:
+            print(f"An error occurred: {e}")
+        for sensor_data in tick:
+            Thread_struct.thread_pool_executor.submit(run_action_sensor, sensor_data)
             
         time.sleep(1)
 
@@ -108,7 +108,7 @@ db_heads = [f'H{i:>02}_' for i in gen.sensor['heads']]
 
 
 
-encoder_data = gen.encoder_data[head]
+encoder_data = gen.encoder_data[head].frame()
 encoder_data[head].std()
 
 
@@ -12,7 +12,7 @@ import shutil
 from modules.preprocessing import Extract
 from modules.preprocessing import ExtractPlc
 from modules.trainer import Trainer
-from modules.config import EQTQ, PLC, DRIVE, TrainArgs, InferArgs
+from modules.config import EQTQ, PLC, DRIVE, TrainArgs, InferArgs, stack_heads
 from tqdm import tqdm
 from functools import partialmethod
 
@@ -37,17 +37,16 @@ def main(inf_args, train_args):
     data_obj.set_unk_variables()
     
     if inf_args.category=='plc':
-        extract_obj = ExtractPlc(data_obj.sensors, inf_args.category, inf_args.machinery)
+        extract_obj = ExtractPlc(data_obj.sensors, inf_args.category, inf_args.machinery, reader=inf_args.reader, cache_dir=inf_args.cache_dir)
     else:
-        extract_obj = Extract(data_obj.sensors, inf_args.category, inf_args.machinery)
-    _ = extract_obj.get_raw_data()
+        extract_obj = Extract(data_obj.sensors, inf_args.category, inf_args.machinery, reader=inf_args.reader, cache_dir=inf_args.cache_dir)
     
     extracted_data = extract_obj.extract_raw_data()
     
     pre_data, det_sensors = extract_obj.preprocess_data(extracted_data)
     if inf_args.sensor in det_sensors:
         return 0
-    filled_df = extract_obj.fill_data(extracted_data, det_sensors)
+    filled_df = extract_obj.fill_data(extracted_data, det_sensors, inplace=True)
 
     data_obj.load_data(filled_df)
     train_data = data_obj.get_sensor(inf_args.sensor)
@@ -57,6 +56,12 @@ def main(inf_args, train_args):
         train_data[var] = train_data[var].abs()
     
     
+    target, group_ids = train_args.target, train_args.group_ids
+    if train_args.multi_head and inf_args.category!='plc':
+        # One model for all the heads, the head is a group id of the series
+        train_data = stack_heads(train_data, data_obj.unk_variables)
+        target, group_ids = ['value'], train_args.group_ids + ['head']
+    
     train_args.set_train_cutoff(train_data)
     trainer = Trainer(
                 learning_rate = train_args.learning_rate,
@@ -71,9 +76,9 @@ def main(inf_args, train_args):
                 train_args.training_cutoff,
                 train_args.max_prediction_length,
                 train_args.max_encoder_length,
-                train_args.target,
+                target,
                 data_obj.unk_variables,
-                train_args.group_ids
+                group_ids
             )
 
     _ = trainer.set_model(
@@ -87,7 +92,7 @@ def main(inf_args, train_args):
                 inf_args.machinery,
                 inf_args.category,
                 inf_args.sensor,
-                train_args.target,
+                ['heads'] if train_args.multi_head and inf_args.category!='plc' else train_args.target,
                 train_args.devices,
                 train_args.logs_dir,
                 train_args.checkpoints_dir,
@@ -108,9 +113,12 @@ def main(inf_args, train_args):
     else:
         print("model does not exists")
         print("start training model")
-        trainer.fit()
+        trainer.fit(export=train_args.export or inf_args.backend == 'torchscript')
         print("model have been trained successfully")
 
+    if train_args.quantize_check or inf_args.quantize:
+        trainer.check_quantization()
+
 
     return det_sensors
 
@@ -123,7 +131,7 @@ def run_eqtq_drive(task, i):
         det_sensors = pickle.load(handle)
     for pid in task:
         inf_args = InferArgs(heads=pid[0], category=pid[1], sensor=pid[2], machinery=pid[3])
-        train_args = TrainArgs(target=[pid[4]])
+        train_args = TrainArgs(target=[pid[4]], multi_head=pid[4]=='heads')
         dist = f"MODEL: {pid[3]+',': <{7}} {pid[1]+',': <{7}} {pid[2]+',': <{17}} {pid[4]+','}"
         try:
             with open(os.devnull, "w") as f, contextlib.redirect_stdout(f):
@@ -191,6 +199,9 @@ def train():
             if category=='eqtq':
                 sensors = eqtq_sensors
             for sensor in sensors:
+                if train_args.multi_head:
+                    tasks.append([n_heads, category, sensor, machinery, 'heads'])
+                    continue
                 for head in heads:
                     tasks.append([n_heads, category, sensor, machinery, head])
                     